@@ -0,0 +1,531 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the grounded bitset encoding of the UPDomain states."""
+
+from collections import OrderedDict
+from fractions import Fraction
+from typing import Any, Dict, List, Optional, Tuple
+import unified_planning as up
+from unified_planning.model import FNode, UPState
+from unified_planning.plans import ActionInstance
+from unified_planning.model.metrics import (
+    MinimizeActionCosts,
+    MinimizeSequentialPlanLength,
+)
+from skdecide.core import EmptySpace, Value
+from skdecide.hub.space.gym import SetSpace
+from skdecide.hub.domain.up import SkUPAction, SkUPState, UPDomain
+
+
+class BitsetState:
+    """State of a grounded problem: its Boolean atoms are the bits of an int,
+    followed by the values of its other (e.g. numeric) fluents."""
+
+    __slots__ = ("bits", "values", "_hash")
+
+    def __init__(self, bits: int, values: Tuple[FNode, ...] = ()):
+        self.bits = bits
+        self.values = values
+        self._hash = hash((bits, values))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, BitsetState)
+            and self.bits == other.bits
+            and self.values == other.values
+        )
+
+    def __getstate__(self):
+        return (self.bits, self.values)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self) -> str:
+        return "BitsetState({}, {})".format(bin(self.bits), self.values)
+
+
+class _GroundAction(SkUPAction):
+    """SkUPAction of a ground action with its index in the domain. It is equal
+    to the SkUPAction of the same grounded action, whose hash is computed once."""
+
+    def __init__(
+        self,
+        index: int,
+        grounded_action: "up.model.InstantaneousAction",
+        action: "up.model.InstantaneousAction",
+        parameters: Tuple[FNode, ...],
+    ):
+        super().__init__(
+            grounded_action, ungrounded_action=action, orig_params=parameters
+        )
+        self.index = index
+        self._hash = super().__hash__()
+        self._action_instance: Optional[ActionInstance] = None
+
+    @property
+    def action_instance(self) -> ActionInstance:
+        """The UP action instance of the ground action, built on first use."""
+        if self._action_instance is None:
+            self._action_instance = ActionInstance(
+                self._ungrounded_action, self._orig_params
+            )
+        return self._action_instance
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other or (
+            isinstance(other, SkUPAction) and super().__eq__(other)
+        )
+
+
+def _literals(expression: FNode, literals: List[Tuple[FNode, bool]]) -> bool:
+    """Appends the literals of a conjunction of Boolean fluent expressions to
+    the given list, returning False if the expression is not such a conjunction."""
+    if expression.is_and():
+        return all(_literals(arg, literals) for arg in expression.args)
+    elif expression.is_not() and expression.arg(0).is_fluent_exp():
+        literals.append((expression.arg(0), False))
+    elif expression.is_fluent_exp() and expression.fluent().type.is_bool_type():
+        literals.append((expression, True))
+    elif not expression.is_true():
+        return False
+    return True
+
+
+class _SuccessorGenerator:
+    """Decision tree over the atoms, in the style of Fast Downward's successor
+    generator, which finds the actions whose preconditions are satisfied by a
+    state by only visiting the branches matching its atoms.
+
+    Each node splits the actions on the lowest atom that their remaining
+    preconditions mention, into those requiring it true, those requiring it
+    false and those not depending on it. The actions whose preconditions are
+    not compiled into masks are left unindexed.
+    """
+
+    __slots__ = ("_root", "unindexed")
+
+    def __init__(self, preconditions: List[Optional[Tuple[int, int]]]):
+        """
+        :param preconditions: The masks of the atoms required true and false by
+            each action, or None if its preconditions are not compiled.
+        """
+        self.unindexed = [i for i, masks in enumerate(preconditions) if masks is None]
+        entries = [
+            (i, masks[0], masks[1])
+            for i, masks in enumerate(preconditions)
+            if masks is not None
+        ]
+        # nodes are [actions, atom mask, true child, false child, other child]
+        self._root = [[], 0, None, None, None]
+        stack = [(self._root, entries)]
+        while len(stack) > 0:
+            node, entries = stack.pop()
+            mentioned = 0
+            for i, positive, negative in entries:
+                if positive | negative == 0:
+                    node[0].append(i)
+                else:
+                    mentioned |= positive | negative
+            if mentioned == 0:
+                continue
+            atom = mentioned & -mentioned
+            node[1] = atom
+            children = ([], [], [])
+            for i, positive, negative in entries:
+                if positive & atom:
+                    children[0].append((i, positive & ~atom, negative))
+                elif negative & atom:
+                    children[1].append((i, positive, negative & ~atom))
+                elif positive | negative:
+                    children[2].append((i, positive, negative))
+            for c, child_entries in enumerate(children):
+                if len(child_entries) > 0:
+                    node[2 + c] = [[], 0, None, None, None]
+                    stack.append((node[2 + c], child_entries))
+
+    def applicable(self, bits: int) -> List[int]:
+        """Returns the sorted indices of the indexed actions applicable in the
+        state whose atoms are the given bits."""
+        applicable = []
+        stack = [self._root]
+        while len(stack) > 0:
+            actions, atom, true_child, false_child, other_child = stack.pop()
+            applicable.extend(actions)
+            if other_child is not None:
+                stack.append(other_child)
+            child = true_child if bits & atom else false_child
+            if child is not None:
+                stack.append(child)
+        applicable.sort()
+        return applicable
+
+
+class BitsetUPDomain(UPDomain):
+    """UPDomain compiled from the grounded problem, whose states are
+    BitsetState instances.
+
+    Ground actions whose preconditions are conjunctions of Boolean literals
+    and whose effects assign constants to Boolean fluents (and increase the
+    'total-cost' fluent by a constant) are compiled into bit masks, indexed
+    by a successor generator, so that computing the applicable actions and
+    applying them are bit operations. The other actions, the state invariants,
+    the goals if not a conjunction of Boolean literals, and the quality
+    metrics other than constant action costs and plan length are evaluated
+    by the UP simulator on the equivalent UP state.
+    """
+
+    def __init__(
+        self,
+        problem: "up.model.Problem",
+        fluent_domains: Optional[Dict] = None,
+        action_encoding: str = "native",
+        applicable_cache_size: int = 1024,
+        **simulator_params
+    ):
+        """
+        :param problem: The UP problem to wrap.
+        :param fluent_domains: The min and max values of the fluents, as in UPDomain.
+        :param action_encoding: The encoding of the actions, as in UPDomain.
+        :param applicable_cache_size: The number of states whose applicable
+            actions are kept to derive those of their successors (0 disables it).
+        :param simulator_params: The parameters of the UP sequential simulator.
+        """
+        self._ground_actions = None
+        self._applicable_cache_size = applicable_cache_size
+        super().__init__(
+            problem,
+            fluent_domains=fluent_domains,
+            state_encoding="native",
+            action_encoding=action_encoding,
+            **simulator_params
+        )
+        self._state_encoding = "bitset"
+        if self._ground_actions is None:
+            self._compile()
+
+    def _compile(self):
+        em = self._problem.environment.expression_manager
+        self._true_node, self._false_node = em.TRUE(), em.FALSE()
+        static_fluents = self._problem.get_static_fluents()
+        self._static_values: Dict[FNode, FNode] = {}
+        self._atoms: List[FNode] = []
+        self._value_fluents: List[FNode] = []
+        for fn, value in self._problem.initial_values.items():
+            if fn.fluent().name == "total-cost":
+                continue
+            elif fn.fluent() in static_fluents:
+                self._static_values[fn] = value
+            elif fn.fluent().type.is_bool_type():
+                self._atoms.append(fn)
+            else:
+                self._value_fluents.append(fn)
+        self._atom_index = {fn: i for i, fn in enumerate(self._atoms)}
+        self._total_cost_zero = None
+        if self._total_cost is not None:
+            self._total_cost_zero = (
+                em.Int(0)
+                if self._total_cost.fluent().type.is_int_type()
+                else em.Real(Fraction(0))
+            )
+        self._compile_goals()
+
+        # constant costs of the lifted actions, or None if unknown
+        action_costs = None
+        if len(self._problem.quality_metrics) == 1:
+            metric = self._problem.quality_metrics[0]
+            if isinstance(metric, MinimizeSequentialPlanLength):
+                action_costs = {a: 1 for a in self._problem.actions}
+            elif isinstance(metric, MinimizeActionCosts):
+                action_costs = {}
+                for a in self._problem.actions:
+                    cost = metric.get_action_cost(a)
+                    if cost is not None and cost.is_constant():
+                        action_costs[a] = cost.constant_value()
+
+        self._ground_actions: List[_GroundAction] = []
+        # masks of the atoms required true and false by the preconditions, and
+        # set true and false by the effects (None if not compiled)
+        self._preconditions: List[Optional[Tuple[int, int]]] = []
+        self._effects: List[Optional[Tuple[int, int]]] = []
+        self._action_costs: List[Optional[Any]] = []
+        for action, parameters, grounded in self._grounder.get_grounded_actions():
+            if grounded is None:
+                continue
+            masks = self._literal_masks(grounded.preconditions)
+            if masks is not None and masks[0] is None:
+                # statically inapplicable
+                continue
+            self._ground_actions.append(
+                _GroundAction(len(self._ground_actions), grounded, action, parameters)
+            )
+            effect_masks = self._effect_masks(grounded)
+            cost = None
+            if self._total_cost is not None:
+                cost = None if effect_masks is None else effect_masks[2]
+            elif action_costs is not None:
+                cost = action_costs.get(action, None)
+            # the UP simulator also checks the effects and the state invariants
+            self._preconditions.append(
+                None
+                if effect_masks is None or len(self._problem.trajectory_constraints) > 0
+                else masks
+            )
+            self._effects.append(None if effect_masks is None else effect_masks[:2])
+            self._action_costs.append(cost)
+        self._successor_generator = _SuccessorGenerator(self._preconditions)
+        # indexed actions whose preconditions read each atom
+        self._readers: List[List[int]] = [[] for _ in self._atoms]
+        for i, masks in enumerate(self._preconditions):
+            if masks is not None:
+                mentioned = masks[0] | masks[1]
+                while mentioned:
+                    atom = mentioned & -mentioned
+                    self._readers[atom.bit_length() - 1].append(i)
+                    mentioned ^= atom
+        # indexed actions applicable in the recently expanded states, from
+        # which those of their successors are derived
+        self._applicable_cache: "OrderedDict[BitsetState, List[int]]" = OrderedDict()
+        self._actions_np2up = self._ground_actions
+        self._actions_up2np = {a: a.index for a in self._ground_actions}
+
+    def _compile_goals(self):
+        """Compiles the goals of the problem, again whenever they change."""
+        self._goal_masks = self._literal_masks(self._problem.goals)
+
+    def _literal_masks(
+        self, conditions: List[FNode]
+    ) -> Optional[Tuple[Optional[int], int]]:
+        """Returns the masks of the atoms which must be true and false to satisfy
+        the conditions (the first one being None if they cannot be satisfied),
+        or None if they are not conjunctions of Boolean literals."""
+        literals: List[Tuple[FNode, bool]] = []
+        if not all(_literals(c, literals) for c in conditions):
+            return None
+        positive, negative = 0, 0
+        for fn, value in literals:
+            if fn in self._static_values:
+                if self._static_values[fn].bool_constant_value() != value:
+                    return None, 0
+            elif fn not in self._atom_index:
+                return None
+            elif value:
+                positive |= 1 << self._atom_index[fn]
+            else:
+                negative |= 1 << self._atom_index[fn]
+        if positive & negative:
+            return None, 0
+        return positive, negative
+
+    def _effect_masks(
+        self, action: "up.model.InstantaneousAction"
+    ) -> Optional[Tuple[int, int, Any]]:
+        """Returns the masks of the atoms set to true and false by the action,
+        along with its increase of the total cost, or None if it has other effects."""
+        if action.simulated_effect is not None:
+            return None
+        add, delete, cost = 0, 0, 0
+        for effect in action.effects:
+            if effect.is_conditional() or effect.is_forall():
+                return None
+            elif (
+                self._total_cost is not None
+                and effect.fluent == self._total_cost
+                and effect.is_increase()
+                and effect.value.is_constant()
+            ):
+                cost += effect.value.constant_value()
+            elif (
+                effect.is_assignment()
+                and effect.fluent in self._atom_index
+                and effect.value.is_bool_constant()
+            ):
+                # the atoms both set true and false are set true, as
+                # by the add-after-delete rule of the UP simulator
+                mask = 1 << self._atom_index[effect.fluent]
+                if effect.value.bool_constant_value():
+                    add |= mask
+                else:
+                    delete |= mask
+            else:
+                return None
+        return add, delete, cost
+
+    def _to_up_state(self, state: BitsetState) -> UPState:
+        values = dict(self._static_values)
+        bits = state.bits
+        for i, fn in enumerate(self._atoms):
+            values[fn] = self._true_node if (bits >> i) & 1 else self._false_node
+        values.update(zip(self._value_fluents, state.values))
+        if self._total_cost is not None:
+            values[self._total_cost] = self._total_cost_zero
+        return UPState(values)
+
+    def _from_up_state(self, up_state: "up.model.State") -> BitsetState:
+        bits = 0
+        for i, fn in enumerate(self._atoms):
+            if up_state.get_value(fn).bool_constant_value():
+                bits |= 1 << i
+        return BitsetState(
+            bits, tuple(up_state.get_value(fn) for fn in self._value_fluents)
+        )
+
+    def _init_action_encoding_(self):
+        if self._ground_actions is None:
+            self._compile()
+
+    def _convert_to_skup_state_(self, state):
+        return None if state is None else SkUPState(self._to_up_state(state))
+
+    def _convert_from_skup_state_(self, skup_state: SkUPState):
+        return self._from_up_state(skup_state.up_state)
+
+    def _convert_to_skup_action_(self, action):
+        if self._action_encoding == "int":
+            return self._ground_actions[int(action)]
+        return action
+
+    def _convert_from_skup_action_(self, skup_action: SkUPAction):
+        if self._action_encoding == "int":
+            if isinstance(skup_action, _GroundAction):
+                return skup_action.index
+            return self._actions_up2np[skup_action]
+        return skup_action
+
+    def _get_observation_space_(self):
+        raise RuntimeError("Observation space not defined for state encoding 'bitset'")
+
+    def _get_initial_state_(self) -> BitsetState:
+        return self._from_up_state(UPState(self._problem.initial_values))
+
+    def _get_next_state(self, memory: BitsetState, action) -> BitsetState:
+        action = self._convert_to_skup_action_(action)
+        effects = self._effects[action.index]
+        if effects is not None:
+            next_state = BitsetState(
+                (memory.bits & ~effects[1]) | effects[0], memory.values
+            )
+        else:
+            next_state = self._simulate(memory, action)
+        if (
+            memory in self._applicable_cache
+            and next_state not in self._applicable_cache
+        ):
+            self._derive_applicable(memory, next_state)
+        return next_state
+
+    def _simulate(self, memory: BitsetState, action: _GroundAction) -> BitsetState:
+        up_state = self._to_up_state(memory)
+        next_up_state = self._simulator.apply(
+            up_state, action.up_action, action.up_parameters
+        )
+        if next_up_state is None:
+            raise RuntimeError(
+                "Action {} is not applicable in state {}".format(action, memory)
+            )
+        next_state = self._from_up_state(next_up_state)
+        if self._total_cost is not None:
+            self._transition_costs[(memory, action.index, next_state)] = (
+                next_up_state.get_value(self._total_cost).constant_value()
+                - up_state.get_value(self._total_cost).constant_value()
+            )
+        return next_state
+
+    def _get_transition_value(
+        self, memory: BitsetState, action, next_state: Optional[BitsetState] = None
+    ) -> Value:
+        index = self._convert_to_skup_action_(action).index
+        cost = self._action_costs[index]
+        if cost is not None:
+            return Value(cost=cost)
+        if self._total_cost is not None:
+            key = (memory, index, next_state)
+            if next_state is None or key not in self._transition_costs:
+                key = (memory, index, self._get_next_state(memory, action))
+            return Value(cost=self._transition_costs[key])
+        return super()._get_transition_value(memory, action, next_state)
+
+    def _is_terminal(self, memory: BitsetState) -> bool:
+        if self._goal_masks is None:
+            return self._simulator.is_goal(self._to_up_state(memory))
+        positive, negative = self._goal_masks
+        return (
+            positive is not None
+            and memory.bits & positive == positive
+            and memory.bits & negative == 0
+        )
+
+    def _is_applicable_action(self, memory: BitsetState, action) -> bool:
+        action = self._convert_to_skup_action_(action)
+        masks = self._preconditions[action.index]
+        if masks is not None:
+            return memory.bits & masks[0] == masks[0] and memory.bits & masks[1] == 0
+        return self._simulator.is_applicable(
+            self._to_up_state(memory), action.up_action, action.up_parameters
+        )
+
+    def _cache_applicable(self, state: BitsetState, applicable: List[int]):
+        if self._applicable_cache_size > 0:
+            self._applicable_cache[state] = applicable
+            if len(self._applicable_cache) > self._applicable_cache_size:
+                self._applicable_cache.popitem(last=False)
+
+    def _derive_applicable(self, memory: BitsetState, next_state: BitsetState):
+        """Caches the indexed actions applicable in the successor of a state
+        whose applicable actions are cached, by only checking again the
+        actions reading the atoms changed by the transition."""
+        changed = memory.bits ^ next_state.bits
+        candidates = set()
+        while changed:
+            atom = changed & -changed
+            candidates.update(self._readers[atom.bit_length() - 1])
+            changed ^= atom
+        bits = next_state.bits
+        applicable = [i for i in self._applicable_cache[memory] if i not in candidates]
+        for i in candidates:
+            positive, negative = self._preconditions[i]
+            if bits & positive == positive and bits & negative == 0:
+                applicable.append(i)
+        applicable.sort()
+        self._cache_applicable(next_state, applicable)
+
+    def _get_applicable_actions_from(self, memory: BitsetState):
+        applicable = self._applicable_cache.get(memory, None)
+        if applicable is None:
+            applicable = self._successor_generator.applicable(memory.bits)
+            self._cache_applicable(memory, applicable)
+        else:
+            self._applicable_cache.move_to_end(memory)
+        if len(self._successor_generator.unindexed) > 0:
+            applicable = list(applicable)
+            up_state = self._to_up_state(memory)
+            for i in self._successor_generator.unindexed:
+                action = self._ground_actions[i]
+                if self._simulator.is_applicable(
+                    up_state, action.up_action, action.up_parameters
+                ):
+                    applicable.append(i)
+            applicable.sort()
+        if len(applicable) == 0:
+            return EmptySpace()
+        if self._action_encoding == "int":
+            return SetSpace(applicable)
+        return SetSpace([self._ground_actions[i] for i in applicable])
@@ -0,0 +1,225 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the cache of built UPDomain instances."""
+
+from collections import OrderedDict
+from copy import copy
+import sys
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional
+import unified_planning as up
+from unified_planning.model import UPState
+from skdecide.hub.domain.up import UPDomain
+
+
+def _attributes(obj: Any) -> List[Any]:
+    """Returns the values of the instance attributes of an object."""
+    values = list(getattr(obj, "__dict__", {}).values())
+    for cls in type(obj).__mro__:
+        slots = getattr(cls, "__slots__", ())
+        for name in (slots,) if isinstance(slots, str) else slots:
+            if name not in ("__dict__", "__weakref__") and hasattr(obj, name):
+                values.append(getattr(obj, name))
+    return values
+
+
+def _is_owned(obj: Any) -> bool:
+    """Tells whether an object reachable from a domain belongs to it, rather
+    than to the problem, the simulator or the Python runtime."""
+    module = type(obj).__module__
+    return (
+        isinstance(obj, UPState)
+        or module.startswith("up_skdecide.")
+        or module.startswith("skdecide.")
+    )
+
+
+def _estimate_size(domain: UPDomain) -> int:
+    """Estimates the memory used by a domain, following the builtin containers
+    and the scikit-decide, engine and UP state objects reachable from its
+    attributes, i.e. its encoding and memoization tables with their states.
+    The other objects are shared with the problem and the simulator and are
+    not counted."""
+    size = sys.getsizeof(domain)
+    seen = {id(domain)}
+    stack = _attributes(domain)
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif _is_owned(obj):
+            stack.extend(_attributes(obj))
+        elif len(_attributes(obj)) > 0:
+            # shared with the problem or the simulator
+            continue
+        size += sys.getsizeof(obj)
+    return size
+
+
+class _ProblemKey:
+    """Key of a problem in the domain cache, whose hash is computed once per
+    lookup instead of on every comparison of the dictionary."""
+
+    __slots__ = ("problem", "_hash")
+
+    def __init__(self, problem: "up.model.Problem"):
+        self.problem = problem
+        self._hash = hash(problem)
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        return (
+            isinstance(other, _ProblemKey)
+            and self._hash == other._hash
+            and self.problem == other.problem
+        )
+
+
+def problem_key(problem: "up.model.Problem") -> Hashable:
+    """Returns the key of a problem in the domain cache. The key is computed
+    from the structure of the problem on every solve, so that a problem
+    modified in place gets a new domain."""
+    return _ProblemKey(problem)
+
+
+# memoization tables filled by a domain while solving, e.g. the UP states of
+# the encoded states and the costs of the transitions
+_MEMO_TABLES = (
+    "_states_up2np",
+    "_states_np2up",
+    "_transition_costs",
+    "_applicable_cache",
+)
+
+
+def _fresh_copy(domain: UPDomain) -> UPDomain:
+    """Returns a shallow copy of a domain with empty memoization tables of its
+    own, so that the cached domain does not grow with the solves."""
+    domain = copy(domain)
+    for name in _MEMO_TABLES:
+        table = getattr(domain, name, None)
+        if table is not None:
+            setattr(domain, name, type(table)())
+    return domain
+
+
+def _close_executors(domain: UPDomain):
+    """Stops the worker processes or threads owned by a domain, if any."""
+    pool = getattr(domain, "_simulated_effect_pool", None)
+    if pool is not None:
+        pool.close()
+
+
+class DomainCache:
+    """LRU cache of built UPDomain instances.
+
+    The cached domains are never handed out: `get` returns shallow copies
+    of them, which share the expensive parts of the domain (UP simulator,
+    grounder and encoding tables) but can be reset and auto-cast by
+    scikit-decide solvers independently from each other. The copies have
+    their own memoization tables, dropped with them after the solve, so the
+    size of a cached domain is estimated once when it is built.
+    """
+
+    def __init__(self, max_size: int = 8, max_memory: Optional[int] = None):
+        """
+        :param max_size: The maximum number of cached domains.
+        :param max_memory: The maximum memory (in bytes) used by the cached
+            domains, or None if unbounded.
+        """
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self._domains: "OrderedDict[Hashable, UPDomain]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._domains)
+
+    def get(self, key: Optional[Hashable], builder: Callable[[], UPDomain]) -> Any:
+        """Returns a copy of the domain cached with the given key, building
+        and caching it with `builder` if missing. A None key disables caching."""
+        if key is None or self.max_size <= 0:
+            return builder()
+        with self._lock:
+            domain = self._domains.get(key, None)
+            if domain is not None:
+                self._domains.move_to_end(key)
+        if domain is None:
+            domain = builder()
+            size = None if self.max_memory is None else _estimate_size(domain)
+            with self._lock:
+                self._domains[key] = domain
+                if size is not None:
+                    self._sizes[key] = size
+                self._evict()
+        return _fresh_copy(domain)
+
+    def set_limits(self, max_size: int = 8, max_memory: Optional[int] = None):
+        """Sets the limits of the cache, evicting the least recently used
+        domains exceeding them.
+
+        :param max_size: The maximum number of cached domains.
+        :param max_memory: The maximum memory (in bytes) used by the cached
+            domains, or None if unbounded.
+        """
+        if not all(
+            isinstance(limit, int) and limit >= 0
+            for limit in (max_size, 0 if max_memory is None else max_memory)
+        ):
+            raise RuntimeError(
+                "The domain cache limits must be non-negative integers. Provided: {}, {}".format(
+                    max_size, max_memory
+                )
+            )
+        with self._lock:
+            self.max_size = max_size
+            self.max_memory = max_memory
+            self._evict()
+
+    def clear(self):
+        """Removes all the cached domains, closing their executors."""
+        with self._lock:
+            for domain in self._domains.values():
+                _close_executors(domain)
+            self._domains.clear()
+            self._sizes.clear()
+
+    def _evict(self):
+        while len(self._domains) > self.max_size:
+            self._pop()
+        if self.max_memory is not None:
+            for key, domain in self._domains.items():
+                if key not in self._sizes:
+                    # cached before the memory limit was set
+                    self._sizes[key] = _estimate_size(domain)
+            total = sum(self._sizes.values())
+            # the most recently used domain is always kept
+            while total > self.max_memory and len(self._domains) > 1:
+                total -= self._pop()
+
+    def _pop(self) -> int:
+        """Evicts the least recently used domain, returning its estimated size."""
+        key, domain = self._domains.popitem(last=False)
+        _close_executors(domain)
+        return self._sizes.pop(key, 0)
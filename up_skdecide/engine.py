@@ -14,18 +14,126 @@
 #
 """This module defines the engine interface."""
 
-from copy import deepcopy
+from contextlib import contextmanager, nullcontext
+from copy import copy
+from dataclasses import dataclass, field, replace
+from fractions import Fraction
 import inspect
+import os
+import queue
+import signal
+import threading
+import time
+import tracemalloc
+from types import MappingProxyType, SimpleNamespace
+from warnings import warn
+import numpy as np
 import unified_planning as up
 from unified_planning.engines import PlanGenerationResultStatus, Engine, Credits
-from unified_planning.engines.mixins import OneshotPlannerMixin
-from unified_planning.plans import ActionInstance, SequentialPlan
+from unified_planning.engines import (
+    FailedValidationReason,
+    ValidationResult,
+    ValidationResultStatus,
+)
+from unified_planning.engines.results import LogLevel, LogMessage
+from unified_planning.engines.mixins import (
+    AnytimeGuarantee,
+    AnytimePlannerMixin,
+    OneshotPlannerMixin,
+    PlanValidatorMixin,
+    ReplannerMixin,
+    SequentialSimulatorMixin,
+)
+from unified_planning.engines.plan_validator import SequentialPlanValidator
+from unified_planning.engines.sequential_simulator import (
+    UPSequentialSimulator,
+    evaluate_quality_metric,
+    evaluate_quality_metric_in_initial_state,
+)
+from unified_planning.exceptions import (
+    UPConflictingEffectsException,
+    UPInvalidActionError,
+    UPProblemDefinitionError,
+    UPUsageError,
+)
+from unified_planning.plans import ActionInstance, PlanKind, SequentialPlan
 from unified_planning.model import ProblemKind
-from typing import Optional, Callable, IO
-from skdecide.hub.domain.up import UPDomain
+from unified_planning.model.metrics import (
+    MaximizeExpressionOnFinalState,
+    Oversubscription,
+)
+from typing import (
+    Any,
+    Optional,
+    Callable,
+    Dict,
+    Hashable,
+    IO,
+    Iterator,
+    List,
+    Mapping,
+    Set,
+    Tuple,
+    Union,
+)
+from pathos.helpers import mp
+from skdecide.core import EmptySpace
+from skdecide.hub.domain.up import SkUPAction, SkUPState, UPDomain
+import skdecide.hub.domain.up.up as skdecide_up
 from skdecide.solvers import Solver as SkDecideSolver
 from skdecide.utils import match_solvers
 from skdecide.hub.solver.iw import IW
+from up_skdecide.bitset import BitsetUPDomain, _GroundAction
+from up_skdecide.domain_cache import DomainCache, _close_executors, problem_key
+from up_skdecide.features import atom_features
+from up_skdecide.numpy_state import NumpyUPDomain
+from up_skdecide.simulated_effects import SimulatedEffectCache, SimulatedEffectPool
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# unified_planning >= 1.0 passes a heuristic in place of the callback to _solve
+_SOLVE_HAS_CALLBACK = (
+    "callback" in inspect.signature(OneshotPlannerMixin.solve).parameters
+)
+
+# UPDomain subclasses implementing the state encodings unknown to UPDomain
+_ENCODED_DOMAINS = {"bitset": BitsetUPDomain, "numpy": NumpyUPDomain}
+
+# serializes the rebinding of the simulator class instantiated by UPDomain
+_domain_simulator_lock = threading.Lock()
+
+
+@contextmanager
+def _domain_simulator(simulator: Optional[Any]):
+    """Makes the UPDomain instances built in this context use the given UP
+    simulator class instead of the UPSequentialSimulator: UPDomain instantiates
+    the UPSequentialSimulator itself, so its module name is rebound for the
+    duration of the context only, rather than building a discarded one."""
+    if simulator is None:
+        yield
+        return
+    with _domain_simulator_lock:
+        default = skdecide_up.UPSequentialSimulator
+        skdecide_up.UPSequentialSimulator = lambda problem, **kwargs: simulator(
+            problem=problem, **kwargs
+        )
+        try:
+            yield
+        finally:
+            skdecide_up.UPSequentialSimulator = default
+
+
+# seconds between the checks that the worker processes are still alive
+_LIVENESS_POLL_INTERVAL = 0.1
+
+# seconds given to a terminated worker process to stop before being killed
+_TERMINATION_GRACE_PERIOD = 1.0
+
+# seconds given to a batch worker past the timeout before it is terminated
+_TIMEOUT_GRACE_PERIOD = 1.0
 
 
 credits = Credits(
@@ -39,37 +147,805 @@ credits = Credits(
 )
 
 
-class EngineImpl(Engine, OneshotPlannerMixin):
+def _valid_solver_options(options: Dict[str, Any]) -> bool:
+    return (
+        "solver" in options
+        and isinstance(options["solver"], type)
+        and issubclass(options["solver"], SkDecideSolver)
+        and "config" in options
+        and isinstance(options["config"], dict)
+        and isinstance(options.get("simulator_params", {}), dict)
+    )
+
+
+def _solver_statistics(solver: SkDecideSolver) -> Dict[str, str]:
+    """Collects the search statistics exposed by the given scikit-decide solver."""
+    statistics = {}
+    for stat, getter in (
+        ("explored_states", "get_nb_explored_states"),
+        ("explored_states", "get_nb_of_explored_states"),
+        ("pruned_states", "get_nb_of_pruned_states"),
+        ("solving_time_ms", "get_solving_time"),
+    ):
+        if stat not in statistics and hasattr(solver, getter):
+            try:
+                statistics[stat] = str(getattr(solver, getter)())
+            except RuntimeError:
+                pass
+    if hasattr(solver, "get_intermediate_scores"):
+        # history of (time, width, root state's f-score) at each goal encountered
+        scores = solver.get_intermediate_scores()
+        if len(scores) > 0:
+            statistics["best_cost"] = str(scores[-1][2])
+    return statistics
+
+
+def _state_key(state: Any) -> Hashable:
+    """Returns a hashable key identifying the given (encoded) UPDomain state."""
+    if isinstance(state, np.ndarray):
+        return state.tobytes()
+    elif isinstance(state, dict):
+        return frozenset(state.items())
+    elif isinstance(state, list):
+        return tuple(s.tobytes() for s in state)
+    else:
+        return state
+
+
+def _is_applicable(domain: UPDomain, state: Any, action: Any) -> bool:
+    """Checks the applicability of a single action without computing the
+    whole set of applicable actions of the state."""
+    if isinstance(domain, (BitsetUPDomain, NumpyUPDomain)):
+        return domain._is_applicable_action(state, action)
+    skup_state = domain._convert_to_skup_state_(state)
+    skup_action = domain._convert_to_skup_action_(action)
+    return domain._simulator.is_applicable(
+        skup_state.up_state, skup_action.up_action, skup_action.up_parameters
+    )
+
+
+def _allocate_cores(requested: List[Optional[int]]) -> List[Optional[List[int]]]:
+    """Assigns disjoint sets of CPUs to the portfolio members requesting a given
+    number of cores, wrapping around when more cores are requested than available."""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None for _ in requested]
+    cpus = sorted(os.sched_getaffinity(0))
+    allocation, next_cpu = [], 0
+    for cores in requested:
+        if cores is None:
+            allocation.append(None)
+        else:
+            allocation.append(
+                [cpus[(next_cpu + c) % len(cpus)] for c in range(min(cores, len(cpus)))]
+            )
+            next_cpu += cores
+    return allocation
+
+
+def _sequential_plan(actions: List[SkUPAction]) -> SequentialPlan:
+    """Returns the sequential plan of the given actions, reusing the action
+    instances built once by the ground actions of the domains. A plan needs
+    distinct action instances (e.g. its partial order conversion identifies
+    them), so that the repeated actions get new ones."""
+    instances = []
+    reused = set()
+    for action in actions:
+        if isinstance(action, _GroundAction) and action not in reused:
+            reused.add(action)
+            instances.append(action.action_instance)
+        else:
+            instances.append(ActionInstance(action.up_action, action.up_parameters))
+    return SequentialPlan(instances)
+
+
+def _plan_to_data(plan: SequentialPlan) -> List[Tuple[str, Tuple]]:
+    """Converts a plan to plain data which can be sent between processes."""
+    return [
+        (
+            a.action.name,
+            tuple(
+                (
+                    ("object", p.object().name)
+                    if p.is_object_exp()
+                    else ("constant", p.constant_value())
+                )
+                for p in a.actual_parameters
+            ),
+        )
+        for a in plan.actions
+    ]
+
+
+def _plan_from_data(
+    problem: "up.model.Problem", data: List[Tuple[str, Tuple]]
+) -> SequentialPlan:
+    return SequentialPlan(
+        [
+            ActionInstance(
+                problem.action(name),
+                [problem.object(v) if k == "object" else v for k, v in params],
+            )
+            for name, params in data
+        ]
+    )
+
+
+def _start_process_group():
+    """Makes the current worker process the leader of a new process group, so
+    that its parent process stops it together with its own child processes
+    (e.g. the simulated effect workers)."""
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+
+
+def _stop_process(process: "mp.Process"):
+    """Terminates a worker process and the processes of its group if still
+    alive, and waits for the worker process. The processes of the group are
+    killed if they have not stopped after the grace period, or if they were
+    left behind by the worker process (e.g. when it crashed)."""
+
+    def signal_group(signum: int):
+        try:
+            os.killpg(process.pid, signum)
+        except ProcessLookupError:
+            # the whole group has already exited
+            pass
+
+    if not hasattr(os, "killpg"):
+        if process.is_alive():
+            process.terminate()
+    else:
+        if process.is_alive():
+            signal_group(signal.SIGTERM)
+            process.join(_TERMINATION_GRACE_PERIOD)
+        signal_group(signal.SIGKILL)
+    process.join()
+
+
+def _run_portfolio_member(
+    index: int,
+    options: Dict[str, Any],
+    cores: Optional[List[int]],
+    problem: "up.model.Problem",
+    timeout: Optional[float],
+    results: "mp.Queue",
+):
+    """Solves the problem with a portfolio member in its own process."""
+    _start_process_group()
+    if cores is not None:
+        os.sched_setaffinity(0, cores)
+    try:
+        engine = EngineImpl(
+            solver=options["solver"],
+            config=options["config"],
+            simulator_params=options.get("simulator_params", dict()),
+        )
+        result = engine._solve(problem, None, timeout)
+        results.put(
+            (
+                index,
+                result.status.name,
+                None if result.plan is None else _plan_to_data(result.plan),
+                result.metrics,
+                [(m.level.name, m.message) for m in result.log_messages or []],
+            )
+        )
+    except Exception as e:
+        results.put(
+            (
+                index,
+                PlanGenerationResultStatus.INTERNAL_ERROR.name,
+                None,
+                {},
+                [(LogLevel.ERROR.name, str(e))],
+            )
+        )
+
+
+def _crash_report(
+    index: int, exitcode: Optional[int]
+) -> Tuple[int, str, None, Dict[str, str], List[Tuple[str, str]]]:
+    """Returns the result data of a worker process which exited without
+    reporting its result, e.g. killed by the OS."""
+    return (
+        index,
+        PlanGenerationResultStatus.INTERNAL_ERROR.name,
+        None,
+        {},
+        [
+            (
+                LogLevel.ERROR.name,
+                "The worker process exited with code {}".format(exitcode),
+            )
+        ],
+    )
+
+
+def _timeout_report(
+    index: int,
+) -> Tuple[int, str, None, Dict[str, str], List[Tuple[str, str]]]:
+    """Returns the result data of a worker process terminated for not
+    reporting its result within the timeout."""
+    return (
+        index,
+        PlanGenerationResultStatus.TIMEOUT.name,
+        None,
+        {},
+        [
+            (
+                LogLevel.WARNING.name,
+                "The worker process was terminated after the timeout",
+            )
+        ],
+    )
+
+
+def _run_batch_worker(
+    options: Dict[str, Any],
+    skip_checks: bool,
+    problems: List["up.model.Problem"],
+    tasks: "mp.Queue",
+    results: "mp.Queue",
+):
+    """Solves the problems of a batch in a worker process, with an engine built
+    once, until the None task. The problems are inherited by the forked worker
+    processes (and only pickled by the spawned ones), and each task is the
+    index of a problem and its timeout."""
+    _start_process_group()
+    engine = EngineImpl(**options)
+    engine.skip_checks = skip_checks
+    for index, timeout in iter(tasks.get, None):
+        try:
+            result = engine.solve(problems[index], timeout=timeout)
+            results.put(
+                (
+                    index,
+                    result.status.name,
+                    None if result.plan is None else _plan_to_data(result.plan),
+                    result.metrics,
+                    [(m.level.name, m.message) for m in result.log_messages or []],
+                )
+            )
+        except Exception as e:
+            results.put(
+                (
+                    index,
+                    PlanGenerationResultStatus.INTERNAL_ERROR.name,
+                    None,
+                    {},
+                    [(LogLevel.ERROR.name, str(e))],
+                )
+            )
+
+
+class _SolveMetrics:
+    """Collects the phase timings, domain calls and resource usage of a solve.
+    The domain calls and generated states are only counted when detailed,
+    since every transition then goes through a Python wrapper."""
+
+    def __init__(self, detailed: bool = False):
+        self.start = time.perf_counter()
+        self.detailed = detailed
+        self.values: Dict[str, str] = {}
+        self.calls: Dict[str, int] = {
+            "_get_next_state": 0,
+            "_get_applicable_actions_from": 0,
+        }
+        # hashes of the distinct states returned by the transitions
+        self.generated_states: Set[int] = set()
+        # simulated effect caches of the domains, with their counters at the start
+        self.effect_caches: Dict[int, Tuple[SimulatedEffectCache, int, int]] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.values[name + "_time"] = str(time.perf_counter() - start)
+
+    def instrument(self, domain: UPDomain) -> UPDomain:
+        """Counts the transition and applicable actions computations of the
+        given domain, and the distinct states generated by its transitions
+        (only those made in this process), if detailed."""
+        for method in self.calls if self.detailed else ():
+            counted = getattr(domain, method)
+
+            def counting(*args, method=method, counted=counted, **kwargs):
+                self.calls[method] += 1
+                result = counted(*args, **kwargs)
+                if method == "_get_next_state":
+                    self.generated_states.add(hash(_state_key(result)))
+                return result
+
+            setattr(domain, method, counting)
+        cache = getattr(domain, "_simulated_effect_cache", None)
+        if cache is not None and id(cache) not in self.effect_caches:
+            self.effect_caches[id(cache)] = (cache, cache.hits, cache.misses)
+        return domain
+
+    def collect(self, solver: Optional[SkDecideSolver] = None) -> Dict[str, str]:
+        metrics = dict(self.values)
+        if solver is not None:
+            metrics.update(_solver_statistics(solver))
+        if self.detailed:
+            metrics["next_state_calls"] = str(self.calls["_get_next_state"])
+            metrics["applicable_actions_calls"] = str(
+                self.calls["_get_applicable_actions_from"]
+            )
+            metrics["generated_states"] = str(len(self.generated_states))
+        if len(self.effect_caches) > 0:
+            caches = self.effect_caches.values()
+            metrics["simulated_effect_cache_hits"] = str(
+                sum(c.hits - hits for c, hits, _ in caches)
+            )
+            metrics["simulated_effect_cache_misses"] = str(
+                sum(c.misses - misses for c, _, misses in caches)
+            )
+        if resource is not None:
+            # kilobytes on Linux, bytes on macOS
+            metrics["peak_rss"] = str(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            )
+        if tracemalloc.is_tracing():
+            metrics["tracemalloc_peak"] = str(tracemalloc.get_traced_memory()[1])
+        metrics["engine_internal_time"] = str(time.perf_counter() - self.start)
+        return metrics
+
+
+@dataclass(frozen=True)
+class _EngineConfig:
+    """Engine-specific entries of the configuration dictionary, parsed and
+    validated once when the engine is created. The remaining entries are the
+    keyword arguments of the scikit-decide solver."""
+
+    solver_class: type
+    solver_parameters: Mapping[str, inspect.Parameter]
+    solver_kwargs: Mapping[str, Any]
+    fluent_domains: Optional[Dict] = None
+    state_encoding: str = "native"
+    action_encoding: str = "native"
+    max_plan_length: Optional[int] = None
+    use_domain_cache: bool = True
+    anytime_schedule: Tuple[Mapping[str, Any], ...] = ()
+    progress_callback: Optional[
+        Callable[["up.engines.results.PlanGenerationResult"], None]
+    ] = None
+    progress_interval: float = 1.0
+    # counts the domain calls and generated states in the result metrics
+    detailed_metrics: bool = False
+    simulated_effect_cache_size: int = 0
+    simulated_effect_cache_eviction: str = "lru"
+    simulated_effect_workers: int = 0
+    simulated_effect_executor: str = "process"
+    simulator_params: Mapping[str, Any] = field(default_factory=dict)
+    # part of the domain cache key that does not depend on the problem
+    domain_options_key: Optional[Hashable] = None
+
+    @staticmethod
+    def parse(
+        solver_class: type, config: Dict[str, Any], simulator_params: Dict
+    ) -> "_EngineConfig":
+        """Splits the engine-specific entries from the solver's keyword arguments."""
+        solver_kwargs = dict(config)
+        engine_options = {
+            key: solver_kwargs.pop(key)
+            for key in (
+                "fluent_domains",
+                "state_encoding",
+                "action_encoding",
+                "max_plan_length",
+                "use_domain_cache",
+                "anytime_schedule",
+                "progress_callback",
+                "progress_interval",
+                "detailed_metrics",
+                "simulated_effect_cache_size",
+                "simulated_effect_cache_eviction",
+                "simulated_effect_workers",
+                "simulated_effect_executor",
+            )
+            if key in solver_kwargs
+        }
+        if "anytime_schedule" in engine_options:
+            engine_options["anytime_schedule"] = tuple(
+                MappingProxyType(dict(overrides))
+                for overrides in engine_options["anytime_schedule"]
+            )
+        if engine_options.get("state_encoding", "native") not in (
+            "native",
+            "dictionary",
+            "vector",
+            "variable",
+            "bitset",
+            "numpy",
+        ):
+            raise RuntimeError(
+                "State encoding must be one of 'native', 'dictionary', 'vector', 'variable', 'bitset' or 'numpy'"
+            )
+        if engine_options.get("action_encoding", "native") not in ("native", "int"):
+            raise RuntimeError("Action encoding must be either 'native' or 'int'")
+        max_plan_length = engine_options.get("max_plan_length", None)
+        if max_plan_length is not None and (
+            not isinstance(max_plan_length, int) or max_plan_length < 0
+        ):
+            raise RuntimeError(
+                "The maximum plan length must be a non-negative integer. Provided: {}".format(
+                    max_plan_length
+                )
+            )
+        cache_size = engine_options.get("simulated_effect_cache_size", 0)
+        if not isinstance(cache_size, int) or cache_size < 0:
+            raise RuntimeError(
+                "The simulated effect cache size must be a non-negative integer. Provided: {}".format(
+                    cache_size
+                )
+            )
+        if engine_options.get("simulated_effect_cache_eviction", "lru") not in (
+            "lru",
+            "fifo",
+        ):
+            raise RuntimeError(
+                "The simulated effect cache eviction must be either 'lru' or 'fifo'"
+            )
+        workers = engine_options.get("simulated_effect_workers", 0)
+        if not isinstance(workers, int) or workers < 0:
+            raise RuntimeError(
+                "The number of simulated effect workers must be a non-negative integer. Provided: {}".format(
+                    workers
+                )
+            )
+        if engine_options.get("simulated_effect_executor", "process") not in (
+            "process",
+            "thread",
+        ):
+            raise RuntimeError(
+                "The simulated effect executor must be either 'process' or 'thread'"
+            )
+        if workers > 0 and cache_size > 0:
+            # the cache records the fluents read by the simulated effects, which
+            # is not possible when they are evaluated by the workers
+            raise RuntimeError(
+                "The simulated effect cache cannot be used with simulated effect workers"
+            )
+        simulator = simulator_params.get("simulator", None)
+        if simulator is not None and not (
+            isinstance(simulator, str)
+            or (
+                isinstance(simulator, type)
+                and issubclass(simulator, SequentialSimulatorMixin)
+            )
+        ):
+            raise RuntimeError(
+                "The simulator must be the name of a UP engine or a class implementing the SequentialSimulatorMixin. Provided: {}".format(
+                    simulator
+                )
+            )
+        fluent_domains = engine_options.get("fluent_domains", None)
+        try:
+            domain_options_key = (
+                engine_options.get("state_encoding", "native"),
+                engine_options.get("action_encoding", "native"),
+                None if fluent_domains is None else frozenset(fluent_domains.items()),
+                frozenset(simulator_params.items()),
+                cache_size,
+                engine_options.get("simulated_effect_cache_eviction", "lru"),
+                workers,
+                engine_options.get("simulated_effect_executor", "process"),
+            )
+            hash(domain_options_key)
+        except TypeError:
+            domain_options_key = None
+        solver_parameters = inspect.signature(solver_class.__init__).parameters
+        if "state_features" in solver_parameters:
+            solver_kwargs.setdefault("state_features", atom_features)
+        return _EngineConfig(
+            solver_class=solver_class,
+            solver_parameters=solver_parameters,
+            solver_kwargs=MappingProxyType(solver_kwargs),
+            simulator_params=MappingProxyType(dict(simulator_params)),
+            domain_options_key=domain_options_key,
+            **engine_options
+        )
+
+    def anytime_configs(self) -> Iterator["_EngineConfig"]:
+        """Yields the configurations to run in sequence in anytime mode, i.e.
+        this configuration updated with each entry of the anytime schedule."""
+        if len(self.anytime_schedule) == 0:
+            yield self
+        for overrides in self.anytime_schedule:
+            yield replace(
+                self,
+                solver_kwargs=MappingProxyType({**self.solver_kwargs, **overrides}),
+            )
+
+    def domain_key(self, problem: "up.model.Problem") -> Optional[Hashable]:
+        """Returns the key identifying the UPDomain of the given problem in the
+        domain cache, or None if the domain must not be cached."""
+        if (
+            not self.use_domain_cache
+            or self.domain_options_key is None
+            or self.simulated_effect_workers > 0
+        ):
+            return None
+        return (problem_key(problem), self.domain_options_key)
+
+    def domain_source(
+        self, problem: "up.model.Problem"
+    ) -> Tuple[DomainCache, Optional[Hashable]]:
+        """Returns the cache from which the domains of a solve are copied, and
+        the key of the problem in it. The domains owning the executors of the
+        simulated effect workers are not kept in the domain cache shared by the
+        engines, but only shared within the solve by a cache of their own,
+        which closes the executors once cleared at the end of the solve."""
+        if self.simulated_effect_workers > 0:
+            return DomainCache(max_size=1), ()
+        return EngineImpl.domain_cache, self.domain_key(problem)
+
+    def build_domain(self, problem: "up.model.Problem") -> UPDomain:
+        simulator_params = dict(self.simulator_params)
+        simulator = simulator_params.pop("simulator", None)
+        # UPDomain only uses the SequentialSimulatorMixin interface of its
+        # simulator, so that any UP sequential simulator can replace it
+        if isinstance(simulator, str):
+            simulator = problem.environment.factory.engine(simulator)
+        with _domain_simulator(simulator):
+            if self.state_encoding in _ENCODED_DOMAINS:
+                domain = _ENCODED_DOMAINS[self.state_encoding](
+                    problem,
+                    fluent_domains=self.fluent_domains,
+                    action_encoding=self.action_encoding,
+                    **simulator_params
+                )
+            else:
+                domain = UPDomain(
+                    problem,
+                    fluent_domains=self.fluent_domains,
+                    state_encoding=self.state_encoding,
+                    action_encoding=self.action_encoding,
+                    **simulator_params
+                )
+        if (
+            self.state_encoding not in _ENCODED_DOMAINS
+            and self.action_encoding == "int"
+        ):
+            # decode the indices into ground actions building their action
+            # instances once, as in the encoded domains
+            domain._actions_np2up = [
+                _GroundAction(i, a._up_action, a._ungrounded_action, a._orig_params)
+                for i, a in enumerate(domain._actions_np2up)
+            ]
+        if self.simulated_effect_cache_size > 0:
+            domain._simulated_effect_cache = SimulatedEffectCache(
+                self.simulated_effect_cache_size,
+                self.simulated_effect_cache_eviction,
+            )
+            domain._simulated_effect_cache.install(domain._simulator)
+        if self.simulated_effect_workers > 0:
+            domain._simulated_effect_pool = SimulatedEffectPool(
+                self.simulated_effect_workers, self.simulated_effect_executor
+            )
+            domain._simulated_effect_pool.install(domain)
+        return domain
+
+
+def _plan_cost(problem: "up.model.Problem", plan: SequentialPlan) -> float:
+    """Returns the cost of a valid plan according to the quality metrics of the
+    problem (metrics to maximize count negatively), or its length if none."""
+    if len(problem.quality_metrics) == 0:
+        return len(plan.actions)
+    validation = SequentialPlanValidator().validate(problem, plan)
+    return sum(
+        (
+            -float(value)
+            if isinstance(metric, (MaximizeExpressionOnFinalState, Oversubscription))
+            else float(value)
+        )
+        for metric, value in validation.metric_evaluations.items()
+    )
+
+
+def _solver_plan(
+    solver: SkDecideSolver, domain: UPDomain
+) -> Optional[List[SkUPAction]]:
+    """Reads the plan computed by solvers exposing a `get_plan` method, so that
+    it does not have to be re-simulated. Returns None if the solver does not
+    expose a plan starting in the initial state of the domain."""
+    if not hasattr(solver, "get_plan"):
+        return None
+    initial_state = domain.get_initial_state()
+    try:
+        if "observation" in inspect.signature(solver.get_plan).parameters:
+            actions = [step[1] for step in solver.get_plan(initial_state)]
+        else:
+            actions = list(solver.get_plan())
+    except RuntimeError:  # raised by search solvers when the plan has cycles
+        return None
+    if len(actions) == 0 and not domain.is_terminal(initial_state):
+        return None
+    return [domain._convert_to_skup_action_(a) for a in actions]
+
+
+class SkDecidePolicy:
+    """Policy computed by a scikit-decide solver, answering the action to apply
+    in a state of the UP problem without solving the problem again.
+
+    The policy holds the solver, which is cleaned up by `close` or at the end
+    of a `with` statement.
+    """
+
+    def __init__(
+        self,
+        solver: SkDecideSolver,
+        domain: UPDomain,
+        domains: Optional[DomainCache] = None,
+    ):
+        self._solver = solver
+        self._domain = domain
+        # cache of the domains owned by the policy, if any
+        self._domains = domains
+        # False for solvers which cannot tell where their policy is defined
+        self._checks_definition = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _observation(self, state: "up.model.UPState") -> Any:
+        return self._domain._convert_from_skup_state_(SkUPState(state))
+
+    def _is_defined_for(self, observation: Any) -> bool:
+        if self._checks_definition:
+            try:
+                return self._solver.is_policy_defined_for(observation)
+            except NotImplementedError:
+                self._checks_definition = False
+        return True
+
+    def is_defined_for(self, state: "up.model.UPState") -> bool:
+        """Returns True iff the solver computed an action for the given state
+        (always True if the solver cannot tell)."""
+        return self._is_defined_for(self._observation(state))
+
+    def __call__(self, state: "up.model.UPState") -> Optional[ActionInstance]:
+        """Returns the action to apply in the given state (as computed by the
+        UP sequential simulator), or None in goal states and where the policy
+        is undefined. The applicability of the action is not checked."""
+        observation = self._observation(state)
+        if self._domain._is_terminal(observation) or not self._is_defined_for(
+            observation
+        ):
+            return None
+        action = self._domain._convert_to_skup_action_(
+            self._solver.sample_action(observation)
+        )
+        return ActionInstance(action.up_action, action.up_parameters)
+
+    def close(self):
+        self._solver._cleanup()
+        if self._domains is not None:
+            self._domains.clear()
+
+
+class _Replanning:
+    """Domain and solver kept alive by a replanner between its resolutions.
+
+    The domain is built once for the replanner's own copy of the problem, so
+    the domains handed to the solver see the updates of its goals and dynamic
+    initial values. The solver, with its explored states, novelty tables or
+    value estimates, is kept as long as the goals and the actions are unchanged.
+    """
+
+    def __init__(self, problem: "up.model.Problem"):
+        self.problem = problem
+        self.static_fluents = problem.get_static_fluents()
+        self.domain: Optional[UPDomain] = None
+        self.solver: Optional[SkDecideSolver] = None
+        # set by the running resolution
+        self.metrics: Optional[_SolveMetrics] = None
+        self.report: Optional[Callable] = None
+        self.timed_out: Optional[Callable[[], bool]] = None
+
+    def domain_factory(self) -> UPDomain:
+        return self.metrics.instrument(copy(self.domain))
+
+    def reset_solver(self):
+        if self.solver is not None:
+            self.solver._cleanup()
+            self.solver = None
+
+    def reset_goals(self):
+        """Drops the solver and compiles the new goals of the problem into the
+        domain (which the encoded domains only do once otherwise)."""
+        self.reset_solver()
+        if isinstance(self.domain, (BitsetUPDomain, NumpyUPDomain)):
+            self.domain._compile_goals()
+
+    def reset(self):
+        """Drops the domain and the solver, e.g. when the grounding changes."""
+        self.reset_solver()
+        if self.domain is not None:
+            _close_executors(self.domain)
+        self.domain = None
+        self.static_fluents = self.problem.get_static_fluents()
+
+
+class EngineImpl(
+    Engine,
+    OneshotPlannerMixin,
+    AnytimePlannerMixin,
+    ReplannerMixin,
+    PlanValidatorMixin,
+):
     """Represents the engine interface."""
 
-    def __init__(self, **options):
-        super().__init__()
-        self.optimality_metric_required = False
+    # UPDomain instances built by all the engines, shared across solves
+    domain_cache = DomainCache()
+
+    def __init__(self, problem=None, error_on_failed_checks=True, **options):
+        Engine.__init__(self)
+        OneshotPlannerMixin.__init__(self)
+        AnytimePlannerMixin.__init__(self)
+        # the problem is only given to replanners
+        self._replanning = None
+        if problem is not None:
+            ReplannerMixin.__init__(self, problem, error_on_failed_checks)
+            self._replanning = _Replanning(self._problem)
         if len(options) == 0:
             self._options = {
                 "solver": IW,
-                "config": {"state_features": lambda d, s: s},
+                "config": {},
             }
-        elif (
-            len(options) != 2
-            or "solver" not in options
-            or not issubclass(options["solver"], SkDecideSolver)
-            or "config" not in options
-            or not isinstance(options["config"], dict)
-        ):
+        elif "portfolio" in options:
+            if not set(options) <= {"portfolio", "portfolio_mode"} or any(
+                not _valid_solver_options(member) for member in options["portfolio"]
+            ):
+                raise RuntimeError(
+                    "SkDecide's UP portfolio only accepts the 'portfolio' option (list of dictionaries with the 'solver' and 'config' options of each member and optionally its 'simulator_params' and number of 'cores') and the 'portfolio_mode' option. Provided options: {}".format(
+                        options
+                    )
+                )
+            if options.get("portfolio_mode", "first") not in ("first", "best"):
+                raise RuntimeError("Portfolio mode must be either 'first' or 'best'")
+            self._options = options
+        elif not set(options) <= {
+            "solver",
+            "config",
+            "simulator_params",
+        } or not _valid_solver_options(options):
             raise RuntimeError(
-                "SkDecide's UP solver only accepts the 'solver' option (SkDecide's underlying solver) and its config dictionary. Provided options: {}".format(
+                "SkDecide's UP solver only accepts the 'solver' option (SkDecide's underlying solver), its config dictionary and the optional 'simulator_params' dictionary. Provided options: {}".format(
                     options
                 )
             )
         else:
             self._options = options
-        self._solver_class = self._options["solver"]
-        self._solver_config = self._options["config"]
-        self._simulator_params = (
-            self._options["simulator_params"]
-            if "simulator_params" in self._options
-            else dict()
+        self._portfolio = [
+            (
+                _EngineConfig.parse(
+                    member["solver"],
+                    member["config"],
+                    member.get("simulator_params", dict()),
+                ),
+                member.get("cores", None),
+            )
+            for member in self._options.get("portfolio", [])
+        ]
+        # the first member's configuration is used out of the portfolio mode
+        self._config = (
+            self._portfolio[0][0]
+            if len(self._portfolio) > 0
+            else _EngineConfig.parse(
+                self._options["solver"],
+                self._options["config"],
+                (
+                    self._options["simulator_params"]
+                    if "simulator_params" in self._options
+                    else dict()
+                ),
+            )
         )
 
     @property
@@ -80,6 +956,10 @@ class EngineImpl(Engine, OneshotPlannerMixin):
     def get_credits(**kwargs) -> Optional["Credits"]:
         return credits
 
+    @staticmethod
+    def ensures(anytime_guarantee: AnytimeGuarantee) -> bool:
+        return anytime_guarantee == AnytimeGuarantee.INCREASING_QUALITY
+
     @staticmethod
     def supported_kind() -> "ProblemKind":
         supported_kind = ProblemKind()
@@ -127,6 +1007,10 @@ class EngineImpl(Engine, OneshotPlannerMixin):
     def supports(problem_kind: "ProblemKind") -> bool:
         return problem_kind <= EngineImpl.supported_kind()
 
+    @staticmethod
+    def supports_plan(plan_kind: "PlanKind") -> bool:
+        return plan_kind == PlanKind.SEQUENTIAL_PLAN
+
     def _solve(
         self,
         problem: "up.model.Problem",
@@ -136,53 +1020,778 @@ class EngineImpl(Engine, OneshotPlannerMixin):
         timeout: Optional[float] = None,
         output_stream: Optional[IO[str]] = None,
     ) -> "up.engines.PlanGenerationResultStatus":
-        solver_config = deepcopy(self._solver_config)
-        if "fluent_domains" in solver_config:
-            fluent_domains = solver_config["fluent_domains"]
-            del solver_config["fluent_domains"]
-        else:
-            fluent_domains = None
-        if "state_encoding" in solver_config:
-            state_encoding = solver_config["state_encoding"]
-            del solver_config["state_encoding"]
-        else:
-            state_encoding = "native"
-        if "action_encoding" in solver_config:
-            action_encoding = solver_config["action_encoding"]
-            del solver_config["action_encoding"]
-        else:
-            action_encoding = "native"
-        domain_factory = lambda: UPDomain(
+        if len(self._portfolio) > 0:
+            return self._solve_portfolio(problem, timeout)
+        return self._plan(
             problem,
-            fluent_domains=fluent_domains,
-            state_encoding=state_encoding,
-            action_encoding=action_encoding,
-            **self._simulator_params
+            self._config,
+            timeout,
+            callback if _SOLVE_HAS_CALLBACK else self._config.progress_callback,
+        )
+
+    def _resolve(
+        self,
+        timeout: Optional[float] = None,
+        output_stream: Optional[IO[str]] = None,
+    ) -> "up.engines.PlanGenerationResult":
+        # the first member's configuration is used out of the portfolio mode
+        return self._plan(
+            self._problem,
+            self._config,
+            timeout,
+            self._config.progress_callback,
+            self._replanning,
         )
+
+    def _update_initial_value(
+        self,
+        fluent: Union["up.model.fnode.FNode", "up.model.fluent.Fluent"],
+        value: Union[
+            "up.model.fnode.FNode",
+            "up.model.fluent.Fluent",
+            "up.model.object.Object",
+            bool,
+            int,
+            float,
+            Fraction,
+        ],
+    ):
+        (fluent_exp,) = self._problem.environment.expression_manager.auto_promote(
+            fluent
+        )
+        self._problem.set_initial_value(fluent_exp, value)
+        if fluent_exp.fluent() in self._replanning.static_fluents:
+            # static fluents are simplified away by the grounding
+            self._replanning.reset()
+
+    def _add_goal(
+        self, goal: Union["up.model.fnode.FNode", "up.model.fluent.Fluent", bool]
+    ):
+        self._problem.add_goal(goal)
+        # the solver's estimates depend on the goals
+        self._replanning.reset_goals()
+
+    def _remove_goal(
+        self, goal: Union["up.model.fnode.FNode", "up.model.fluent.Fluent", bool]
+    ):
+        (goal_exp,) = self._problem.environment.expression_manager.auto_promote(goal)
+        goals = self._problem.goals
+        self._problem.clear_goals()
+        removed = False
+        for g in goals:
+            if not g is goal_exp:
+                self._problem.add_goal(g)
+            else:
+                removed = True
+        if not self._skip_checks and not removed:
+            msg = "goal to remove: {} not found inside the problem goals: {}".format(
+                goal_exp, goals
+            )
+            if self._error_on_failed_checks:
+                raise up.exceptions.UPUsageError(msg)
+            else:
+                warn(msg)
+        # the solver's estimates depend on the goals
+        self._replanning.reset_goals()
+
+    def _add_action(self, action: "up.model.action.Action"):
+        self._problem.add_action(action)
+        self._replanning.reset()
+
+    def _remove_action(self, name: str):
+        actions = self._problem.actions
+        self._problem.clear_actions()
+        removed = False
+        for a in actions:
+            if a.name != name:
+                self._problem.add_action(a)
+            else:
+                removed = True
+        if not self._skip_checks and not removed:
+            msg = (
+                "action to remove: {} not found inside the problem actions: {}".format(
+                    name, [a.name for a in actions]
+                )
+            )
+            if self._error_on_failed_checks:
+                raise up.exceptions.UPUsageError(msg)
+            else:
+                warn(msg)
+        self._replanning.reset()
+
+    def destroy(self):
+        if self._replanning is not None:
+            self._replanning.reset()
+
+    def solve_policy(
+        self, problem: "up.model.Problem", timeout: Optional[float] = None
+    ) -> SkDecidePolicy:
+        """Solves the problem and returns the solver's policy, which can then be
+        queried in any state of the problem instead of following a single plan.
+
+        :param problem: The problem to solve.
+        :param timeout: The time in seconds allowed to solve the problem. The
+            policy is returned anyway on timeout, possibly undefined in more
+            states.
+        :return: The policy, which must be closed once not used anymore.
+        """
+        if len(self._portfolio) > 0:
+            raise RuntimeError("Portfolio engines cannot return policies")
+        if not self.skip_checks and not self.supports(problem.kind):
+            msg = "We cannot establish whether {} can solve this problem!".format(
+                self.name
+            )
+            if self.error_on_failed_checks:
+                raise up.exceptions.UPUsageError(msg)
+            else:
+                warn(msg)
+        config = self._config
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        domains, domain_key = config.domain_source(problem)
+        # the domains of the solver share the memoization tables of this copy
+        solved = domains.get(domain_key, lambda: config.build_domain(problem))
+        domain_factory = lambda: copy(solved)
         domain = domain_factory()
-        if len(match_solvers(domain, [self._solver_class])) == 0:
+        if len(match_solvers(domain, [config.solver_class])) == 0:
             raise RuntimeError(
                 "The scikit-decide's solver {} is not compatible with this problem".format(
-                    self._solver_class.__name__
+                    config.solver_class.__name__
                 )
             )
-        if (
-            "domain_factory"
-            in inspect.signature(self._solver_class.__init__).parameters
-        ):
-            solver_config.update({"domain_factory": domain_factory})
-        plan = []
-        with self._solver_class(**solver_config) as solver:
-            solver.solve()
-            rollout_domain = domain_factory()
-            state = rollout_domain.reset()
-            while not rollout_domain.is_terminal(state):
-                action = solver.sample_action(
-                    state
-                )  # TODO: handle when no action is applicable
-                state = rollout_domain.get_next_state(state, action)
-                plan.append(rollout_domain._convert_to_skup_action_(action))
-        seq_plan = SequentialPlan([ActionInstance(x._up_action) for x in plan])
-        return up.engines.PlanGenerationResult(
-            PlanGenerationResultStatus.SOLVED_SATISFICING, seq_plan, self.name
+        hooks = SimpleNamespace(
+            report=lambda solver, extra_metrics: None,
+            timed_out=lambda: deadline is not None and time.perf_counter() >= deadline,
         )
+        solver = self._new_solver(config, domain_factory, hooks, deadline is not None)
+        solver.solve()
+        return SkDecidePolicy(
+            solver, domain, None if domains is EngineImpl.domain_cache else domains
+        )
+
+    def _validate(
+        self, problem: "up.model.AbstractProblem", plan: "up.plans.Plan"
+    ) -> "up.engines.results.ValidationResult":
+        return self._validate_plans(problem, [plan])[0]
+
+    def validate_batch(
+        self, problem: "up.model.AbstractProblem", plans: List["up.plans.Plan"]
+    ) -> List["up.engines.results.ValidationResult"]:
+        """Validates many plans of the same problem, building its domain once
+        and simulating only once the prefixes shared by several plans.
+
+        :param problem: The problem on which the plans are validated.
+        :param plans: The sequential plans to validate.
+        :return: The validation results, in the order of the plans.
+        """
+        for kind, supported, msg in [
+            (
+                problem.kind,
+                self.supports,
+                "We cannot establish whether {} can validate this problem!",
+            ),
+        ] + [
+            (plan.kind, self.supports_plan, "{} cannot validate this kind of plan!")
+            for plan in plans
+        ]:
+            if not self.skip_checks and not supported(kind):
+                if self.error_on_failed_checks:
+                    raise UPUsageError(msg.format(self.name))
+                else:
+                    warn(msg.format(self.name))
+        return self._validate_plans(problem, plans)
+
+    def _validate_plans(
+        self, problem: "up.model.Problem", plans: List[SequentialPlan]
+    ) -> List["up.engines.results.ValidationResult"]:
+        metric = None
+        if len(problem.quality_metrics) > 0:
+            if len(problem.quality_metrics) == 1:
+                metric = problem.quality_metrics[0]
+            else:
+                raise UPProblemDefinitionError(
+                    "The UP does not support more than one quality metric in the problem."
+                )
+        simulator = EngineImpl.domain_cache.get(
+            self._config.domain_key(problem),
+            lambda: self._config.build_domain(problem),
+        )._simulator
+        initial_state = simulator.get_initial_state()
+        initial_metric_value = (
+            None
+            if metric is None
+            else evaluate_quality_metric_in_initial_state(simulator, metric)
+        )
+        # actions and parameters are compared by identity, as UP expressions
+        keys = [
+            [
+                (id(ai.action), tuple(map(id, ai.actual_parameters)))
+                for ai in plan.actions
+            ]
+            for plan in plans
+        ]
+        # plans sharing a prefix are adjacent in this order
+        order = sorted(range(len(plans)), key=lambda i: keys[i])
+        # simulation of the current plan prefix: action key, next state, metric
+        # value and error message of each step (the last step only can fail)
+        path: List[Tuple[Tuple, Any, Any, Optional[str]]] = []
+        results: List[Optional[ValidationResult]] = [None] * len(plans)
+        for i in order:
+            plan, key = plans[i], keys[i]
+            shared = 0
+            while shared < min(len(path), len(key)) and path[shared][0] == key[shared]:
+                shared += 1
+            del path[shared:]
+            while len(path) < len(key) and (len(path) == 0 or path[-1][3] is None):
+                step = len(path)
+                state = initial_state if step == 0 else path[-1][1]
+                metric_value = initial_metric_value if step == 0 else path[-1][2]
+                ai = plan.actions[step]
+                next_state, msg = None, None
+                try:
+                    if not isinstance(simulator, UPSequentialSimulator):
+                        # other simulators only tell whether actions are applicable
+                        if simulator.is_applicable(state, ai):
+                            next_state = simulator.apply(state, ai)
+                        else:
+                            msg = "{}-th action instance {} is not applicable.".format(
+                                step + 1, ai
+                            )
+                    else:
+                        unsat_conds, _ = simulator.get_unsatisfied_conditions(state, ai)
+                        if unsat_conds:
+                            msg = "Preconditions {} of {}-th action instance {} are not satisfied.".format(
+                                unsat_conds, step + 1, ai
+                            )
+                        else:
+                            next_state = simulator.apply_unsafe(state, ai)
+                except UPUsageError as e:
+                    msg = "{}-th action instance {} creates a UsageError: {}".format(
+                        step + 1, ai, e
+                    )
+                except UPInvalidActionError as e:
+                    msg = (
+                        "{}-th action instance {} creates an Invalid Action: {}".format(
+                            step + 1, ai, e
+                        )
+                    )
+                except UPConflictingEffectsException as e:
+                    msg = "{}-th action instance {} creates Conflicting Effects: {}".format(
+                        step + 1, ai, e
+                    )
+                if msg is None and metric is not None:
+                    metric_value = evaluate_quality_metric(
+                        simulator,
+                        metric,
+                        metric_value,
+                        state,
+                        ai.action,
+                        ai.actual_parameters,
+                        next_state,
+                    )
+                path.append((key[step], next_state, metric_value, msg))
+            metrics = {"reused_steps": str(shared)}
+            trace = [initial_state] + [s for _, s, _, msg in path if msg is None]
+            if len(path) > 0 and path[-1][3] is not None:
+                results[i] = ValidationResult(
+                    ValidationResultStatus.INVALID,
+                    self.name,
+                    [LogMessage(LogLevel.INFO, path[-1][3])],
+                    None,
+                    FailedValidationReason.INAPPLICABLE_ACTION,
+                    inapplicable_action=plan.actions[len(path) - 1],
+                    metrics=metrics,
+                    trace=trace,
+                )
+                continue
+            if isinstance(simulator, UPSequentialSimulator):
+                unsatisfied_goals = simulator.get_unsatisfied_goals(trace[-1])
+            else:
+                unsatisfied_goals = (
+                    [] if simulator.is_goal(trace[-1]) else problem.goals
+                )
+            if len(unsatisfied_goals) == 0:
+                results[i] = ValidationResult(
+                    ValidationResultStatus.VALID,
+                    self.name,
+                    [],
+                    (
+                        None
+                        if metric is None
+                        else {
+                            metric: (
+                                path[-1][2] if len(path) > 0 else initial_metric_value
+                            )
+                        }
+                    ),
+                    metrics=metrics,
+                    trace=trace,
+                )
+            else:
+                results[i] = ValidationResult(
+                    ValidationResultStatus.INVALID,
+                    self.name,
+                    [
+                        LogMessage(
+                            LogLevel.INFO,
+                            "Goals {} are not satisfied by the plan.".format(
+                                unsatisfied_goals
+                            ),
+                        )
+                    ],
+                    None,
+                    FailedValidationReason.UNSATISFIED_GOALS,
+                    metrics=metrics,
+                    trace=trace,
+                )
+        return results
+
+    def solve_batch(
+        self,
+        problems: List["up.model.Problem"],
+        workers: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> Iterator[Tuple[int, "up.engines.PlanGenerationResult"]]:
+        """Solves many problems with a pool of worker processes, each holding
+        an engine (and a domain cache) built once with this engine's options
+        and checks. A worker dying while solving a problem (e.g. killed by the
+        OS) is replaced, and its problem gets an INTERNAL_ERROR result. A
+        worker still solving a problem shortly after the timeout (e.g. with a
+        solver ignoring it) is terminated and replaced, and its problem gets a
+        TIMEOUT result.
+
+        :param problems: The problems to solve.
+        :param workers: The number of worker processes, defaults to the number of CPUs.
+        :param timeout: The time in seconds allowed to solve each problem.
+        :return: An iterator over the pairs of problem index and result, in
+            completion order. A problem raising an error gets an INTERNAL_ERROR
+            result without affecting the other problems.
+        """
+        if len(self._portfolio) > 0:
+            raise RuntimeError("Portfolio engines cannot solve batches of problems")
+        if self._options.get("config", {}).get("progress_callback", None) is not None:
+            raise RuntimeError("Progress callbacks are not supported in batch solving")
+        problems = list(problems)
+        results = mp.Queue()
+        # problems left to solve, in reverse order
+        queued = list(reversed(range(len(problems))))
+        # process and task queue of each worker, and worker solving each problem
+        # with the time it was dispatched
+        processes: List[Tuple["mp.Process", "mp.Queue"]] = []
+        solving: Dict[int, int] = {}
+        started: Dict[int, float] = {}
+
+        def start_worker() -> Tuple["mp.Process", "mp.Queue"]:
+            tasks = mp.Queue()
+            process = mp.Process(
+                target=_run_batch_worker,
+                args=(self._options, self.skip_checks, problems, tasks, results),
+            )
+            process.start()
+            return process, tasks
+
+        def dispatch(worker: int):
+            if len(queued) == 0:
+                processes[worker][1].put(None)
+            else:
+                solving[queued[-1]] = worker
+                started[queued[-1]] = time.perf_counter()
+                processes[worker][1].put((queued.pop(), timeout))
+
+        try:
+            for worker in range(min(workers or os.cpu_count() or 1, len(problems))):
+                processes.append(start_worker())
+                dispatch(worker)
+            # problems whose worker was found dead at the previous poll
+            exited = set()
+            while len(solving) > 0:
+                try:
+                    reports = [results.get(timeout=_LIVENESS_POLL_INTERVAL)]
+                except queue.Empty:
+                    # a dead worker had a whole poll to deliver its result
+                    # before being considered crashed
+                    reports = [
+                        _crash_report(index, processes[solving[index]][0].exitcode)
+                        for index in sorted(exited)
+                        if index in solving
+                    ]
+                    exited = {
+                        index
+                        for index, worker in solving.items()
+                        if not processes[worker][0].is_alive()
+                    }
+                if timeout is not None:
+                    now = time.perf_counter()
+                    reported = {report[0] for report in reports}
+                    for index in sorted(set(solving) - reported):
+                        if now - started[index] > timeout + _TIMEOUT_GRACE_PERIOD:
+                            _stop_process(processes[solving[index]][0])
+                            reports.append(_timeout_report(index))
+                for index, status, plan, metrics, messages in reports:
+                    if index not in solving:
+                        # sent just before its worker was terminated
+                        continue
+                    worker = solving.pop(index)
+                    del started[index]
+                    if not processes[worker][0].is_alive():
+                        _stop_process(processes[worker][0])
+                        processes[worker] = start_worker()
+                    dispatch(worker)
+                    yield index, up.engines.PlanGenerationResult(
+                        PlanGenerationResultStatus[status],
+                        (
+                            None
+                            if plan is None
+                            else _plan_from_data(problems[index], plan)
+                        ),
+                        self.name,
+                        metrics=metrics,
+                        log_messages=[
+                            LogMessage(LogLevel[level], message)
+                            for level, message in messages
+                        ]
+                        or None,
+                    )
+        finally:
+            for process, _ in processes:
+                _stop_process(process)
+
+    def _solve_portfolio(
+        self, problem: "up.model.Problem", timeout: Optional[float] = None
+    ) -> "up.engines.PlanGenerationResult":
+        """Races the portfolio members in separate processes. In 'first' mode
+        the first plan found is returned, in 'best' mode the plan of lowest cost
+        found by the members before the timeout."""
+        start = time.perf_counter()
+        first = self._options.get("portfolio_mode", "first") == "first"
+        results = mp.Queue()
+        processes = [
+            mp.Process(
+                target=_run_portfolio_member,
+                args=(
+                    i,
+                    self._options["portfolio"][i],
+                    cores,
+                    problem,
+                    timeout,
+                    results,
+                ),
+            )
+            for i, cores in enumerate(_allocate_cores([c for _, c in self._portfolio]))
+        ]
+        for process in processes:
+            process.start()
+        best, best_cost, best_member = None, None, None
+        # members which have not reported their result yet, those among them
+        # found dead at the previous poll, and the results not handled yet
+        pending, exited, reports = set(range(len(processes))), set(), []
+        try:
+            while len(pending) > 0:
+                remaining = (
+                    None if timeout is None else timeout - (time.perf_counter() - start)
+                )
+                if remaining is not None and remaining <= 0:
+                    break
+                if len(reports) == 0:
+                    try:
+                        reports.append(
+                            results.get(
+                                timeout=(
+                                    _LIVENESS_POLL_INTERVAL
+                                    if remaining is None
+                                    else min(remaining, _LIVENESS_POLL_INTERVAL)
+                                )
+                            )
+                        )
+                    except queue.Empty:
+                        # a member found dead had a whole poll to deliver its
+                        # result before being considered crashed
+                        reports.extend(
+                            _crash_report(i, processes[i].exitcode)
+                            for i in sorted(pending & exited)
+                        )
+                        exited = {i for i in pending if not processes[i].is_alive()}
+                        continue
+                i, status, plan, metrics, messages = reports.pop()
+                pending.discard(i)
+                result = up.engines.PlanGenerationResult(
+                    PlanGenerationResultStatus[status],
+                    None if plan is None else _plan_from_data(problem, plan),
+                    self.name,
+                    metrics=metrics,
+                    log_messages=[
+                        LogMessage(LogLevel[level], message)
+                        for level, message in messages
+                    ]
+                    or None,
+                )
+                if result.plan is not None:
+                    cost = 0 if first else _plan_cost(problem, result.plan)
+                    if best_cost is None or cost < best_cost:
+                        best, best_cost, best_member = result, cost, i
+                    if first:
+                        break
+                elif best is None or (
+                    best.plan is None
+                    and result.status != PlanGenerationResultStatus.INTERNAL_ERROR
+                ):
+                    best, best_member = result, i
+        finally:
+            for process in processes:
+                _stop_process(process)
+        if best is None:
+            best = up.engines.PlanGenerationResult(
+                PlanGenerationResultStatus.TIMEOUT, None, self.name, metrics={}
+            )
+        elif best.plan is not None:
+            best.metrics["portfolio_winner"] = "{}:{}".format(
+                best_member, self._portfolio[best_member][0].solver_class.__name__
+            )
+        best.metrics["portfolio_time"] = str(time.perf_counter() - start)
+        return best
+
+    def _get_solutions(
+        self,
+        problem: "up.model.Problem",
+        timeout: Optional[float] = None,
+        output_stream: Optional[IO[str]] = None,
+    ) -> Iterator["up.engines.PlanGenerationResult"]:
+        """Runs the solver once per configuration of the anytime schedule and
+        yields an INTERMEDIATE result each time a plan of lower cost is found.
+        The last result yielded is the final one, with the best plan found."""
+        start = time.perf_counter()
+        best_result, best_cost = None, None
+        for config in self._config.anytime_configs():
+            remaining = (
+                None if timeout is None else timeout - (time.perf_counter() - start)
+            )
+            if remaining is not None and remaining <= 0:
+                break
+            result = self._plan(problem, config, remaining, config.progress_callback)
+            if result.plan is None:
+                if best_result is None:
+                    best_result = result
+                if result.status == PlanGenerationResultStatus.TIMEOUT:
+                    break
+                continue
+            cost = _plan_cost(problem, result.plan)
+            if best_cost is None or cost < best_cost:
+                best_result, best_cost = result, cost
+                best_result.metrics["plan_cost"] = str(cost)
+                yield up.engines.PlanGenerationResult(
+                    PlanGenerationResultStatus.INTERMEDIATE,
+                    result.plan,
+                    self.name,
+                    metrics=dict(result.metrics),
+                )
+        if best_result is None:
+            best_result = up.engines.PlanGenerationResult(
+                PlanGenerationResultStatus.TIMEOUT, None, self.name, metrics={}
+            )
+        yield best_result
+
+    def _plan(
+        self,
+        problem: "up.model.Problem",
+        config: _EngineConfig,
+        timeout: Optional[float] = None,
+        callback: Optional[
+            Callable[["up.engines.results.PlanGenerationResult"], None]
+        ] = None,
+        replanning: Optional[_Replanning] = None,
+    ) -> "up.engines.PlanGenerationResult":
+        """Solves the problem with the given configuration of the solver,
+        reporting INTERMEDIATE results with the search statistics to the
+        callback at most every `progress_interval` seconds. The domain and
+        solver of a replanner are reused from its previous resolution when
+        still valid, and the executors of the other domains owning some are
+        closed at the end."""
+        metrics = _SolveMetrics(config.detailed_metrics)
+        deadline = None if timeout is None else metrics.start + timeout
+        timed_out = lambda: deadline is not None and time.perf_counter() >= deadline
+        last_report = metrics.start
+
+        def report(solver, extra_metrics):
+            nonlocal last_report
+            now = time.perf_counter()
+            if callback is None or now - last_report < config.progress_interval:
+                return
+            last_report = now
+            callback(
+                up.engines.PlanGenerationResult(
+                    PlanGenerationResultStatus.INTERMEDIATE,
+                    None,
+                    self.name,
+                    metrics={**metrics.collect(solver), **extra_metrics},
+                )
+            )
+
+        def failure_result(status, solver, message=None):
+            return up.engines.PlanGenerationResult(
+                status,
+                None,
+                self.name,
+                metrics=metrics.collect(solver),
+                log_messages=(
+                    None if message is None else [LogMessage(LogLevel.INFO, message)]
+                ),
+            )
+
+        domains = None
+        if replanning is None:
+            domains, domain_key = config.domain_source(problem)
+            # hooks of the solver's callback
+            hooks = SimpleNamespace()
+        else:
+            hooks = replanning
+            hooks.metrics = metrics
+            domain_factory = replanning.domain_factory
+            metrics.values["replanning_reuse"] = (
+                "solver"
+                if replanning.solver is not None
+                else "domain" if replanning.domain is not None else "none"
+            )
+        try:
+            hooks.report, hooks.timed_out = report, timed_out
+            with metrics.phase("domain_construction"):
+                if replanning is None:
+                    # the domains of the solver share the memoization tables
+                    # of this copy, dropped with them after the solve
+                    solved = domains.get(
+                        domain_key, lambda: config.build_domain(problem)
+                    )
+                    domain_factory = lambda: metrics.instrument(copy(solved))
+                elif replanning.domain is None:
+                    replanning.domain = config.build_domain(problem)
+                domain = domain_factory()
+            with metrics.phase("match_solvers"):
+                compatible = len(match_solvers(domain, [config.solver_class])) > 0
+            if not compatible:
+                raise RuntimeError(
+                    "The scikit-decide's solver {} is not compatible with this problem".format(
+                        config.solver_class.__name__
+                    )
+                )
+            if timed_out():
+                return failure_result(PlanGenerationResultStatus.TIMEOUT, None)
+            solver = None if replanning is None else replanning.solver
+            if solver is None:
+                with metrics.phase("solver_construction"):
+                    solver = self._new_solver(
+                        config,
+                        domain_factory,
+                        hooks,
+                        deadline is not None
+                        or callback is not None
+                        or replanning is not None,
+                    )
+                if replanning is not None:
+                    replanning.solver = solver
+            # the solver of a replanner is cleaned up when dropped
+            with solver if replanning is None else nullcontext():
+                with metrics.phase("solve"):
+                    solver.solve()
+                if timed_out():
+                    return failure_result(PlanGenerationResultStatus.TIMEOUT, solver)
+                with metrics.phase("plan_extraction"):
+                    plan = _solver_plan(solver, domain)
+                    if plan is not None:
+                        plan_extraction, failure = "solver", None
+                    else:
+                        plan_extraction = "rollout"
+                        plan, failure = self._rollout(
+                            solver,
+                            domain_factory(),
+                            config.max_plan_length,
+                            timed_out,
+                            lambda steps: report(solver, {"rollout_steps": str(steps)}),
+                        )
+                metrics.values["plan_extraction"] = plan_extraction
+                if failure is not None:
+                    metrics.values["rollout_steps"] = str(len(plan))
+                    return failure_result(failure[0], solver, failure[1])
+                metrics.values["plan_length"] = str(len(plan))
+                result_metrics = metrics.collect(solver)
+            seq_plan = _sequential_plan(plan)
+            return up.engines.PlanGenerationResult(
+                PlanGenerationResultStatus.SOLVED_SATISFICING,
+                seq_plan,
+                self.name,
+                metrics=result_metrics,
+            )
+        finally:
+            if domains is not None and domains is not EngineImpl.domain_cache:
+                domains.clear()
+
+    @staticmethod
+    def _new_solver(
+        config: _EngineConfig,
+        domain_factory: Callable[[], UPDomain],
+        hooks: Any,
+        use_callback: bool,
+    ) -> SkDecideSolver:
+        """Builds the solver. If `use_callback`, its callback reports the search
+        progress to `hooks.report` and stops the search when `hooks.timed_out()`."""
+        solver_config = dict(config.solver_kwargs)
+        if "domain_factory" in config.solver_parameters:
+            solver_config["domain_factory"] = domain_factory
+        if use_callback and "callback" in config.solver_parameters:
+            # scikit-decide solvers call their callback at each search iteration
+            # and stop searching as soon as it returns True
+            user_callback = solver_config.get("callback", None)
+
+            def solver_callback(solver, *args):
+                hooks.report(solver, {})
+                return hooks.timed_out() or (
+                    user_callback is not None and user_callback(solver, *args)
+                )
+
+            solver_config["callback"] = solver_callback
+        return config.solver_class(**solver_config)
+
+    def _rollout(
+        self,
+        solver: SkDecideSolver,
+        rollout_domain: UPDomain,
+        max_plan_length: Optional[int],
+        timed_out: Callable[[], bool],
+        on_step: Callable[[int], None],
+    ) -> Tuple[
+        List[SkUPAction], Optional[Tuple["up.engines.PlanGenerationResultStatus", str]]
+    ]:
+        """Extracts a plan by executing the solver's policy from the initial state.
+
+        Returns the plan along with the failure status and message explaining
+        why no goal state could be reached (None if the plan is valid)."""
+        plan = []
+        state = rollout_domain.reset()
+        visited = {_state_key(state)}
+        while not rollout_domain.is_terminal(state):
+            on_step(len(plan))
+            if timed_out():
+                return plan, (PlanGenerationResultStatus.TIMEOUT, None)
+            elif max_plan_length is not None and len(plan) >= max_plan_length:
+                return plan, (
+                    PlanGenerationResultStatus.UNSOLVABLE_INCOMPLETELY,
+                    "No goal state reached within {} steps".format(max_plan_length),
+                )
+            action = solver.sample_action(state)
+            if not _is_applicable(rollout_domain, state, action):
+                if isinstance(rollout_domain.get_applicable_actions(state), EmptySpace):
+                    message = "Dead-end state reached: {}".format(state)
+                else:
+                    message = "The solver's policy is undefined in state {}".format(
+                        state
+                    )
+                return plan, (
+                    PlanGenerationResultStatus.UNSOLVABLE_INCOMPLETELY,
+                    message,
+                )
+            state = rollout_domain.get_next_state(state, action)
+            plan.append(rollout_domain._convert_to_skup_action_(action))
+            if _state_key(state) in visited:
+                return plan, (
+                    PlanGenerationResultStatus.UNSOLVABLE_INCOMPLETELY,
+                    "The solver's policy loops over state {}".format(state),
+                )
+            visited.add(_state_key(state))
+        return plan, None
@@ -0,0 +1,531 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the compilation of the UP expressions into Python
+closures over the tuples of fluent values of the encoded states."""
+
+from fractions import Fraction
+from itertools import product
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import unified_planning as up
+from unified_planning.model import FNode
+
+Values = Tuple[Any, ...]
+# constraint rows (coefficients, bound), assignments, increases and total cost
+# increase of a ground action in linear form
+_LinearAction = Tuple[
+    List[Tuple[Dict[int, int], int]], Dict[int, int], Dict[int, int], int
+]
+
+_ASSIGN, _INCREASE, _DECREASE = 0, 1, 2
+
+
+class _NotCompiled(Exception):
+    """Raised on the expressions which cannot be compiled."""
+
+
+class _CompiledAction:
+    """Preconditions and effects of a ground action compiled into closures."""
+
+    __slots__ = ("precondition", "effects", "cost", "may_fail", "_encoders", "_bounds")
+
+    def __init__(
+        self,
+        precondition: Callable[[Values], bool],
+        effects: List[Tuple[Optional[Callable], int, int, Callable, bool]],
+        cost: Callable[[Values], Any],
+        encoders: Sequence[Callable[[Any], Any]],
+        bounds: Sequence[Optional[Tuple[Optional[int], Optional[int]]]],
+    ):
+        self.precondition = precondition
+        # (condition, fluent index, kind, value, Boolean fluent) of each effect
+        self.effects = effects
+        # increase of the total cost
+        self.cost = cost
+        self._encoders = encoders
+        self._bounds = bounds
+        # whether applying the effects can fail when the preconditions hold
+        indices = [i for _, i, _, _, _ in effects]
+        self.may_fail = len(set(indices)) < len(indices) or any(
+            bounds[i] is not None for i in indices
+        )
+
+    def is_applicable(self, values: Values) -> bool:
+        """Returns whether the action is applicable in the state of the given
+        values, i.e. its preconditions hold and its effects can be applied."""
+        return bool(self.precondition(values)) and (
+            not self.may_fail or self.apply(values) is not None
+        )
+
+    def apply(self, values: Values) -> Optional[Values]:
+        """Returns the values of the successor, or None if the effects conflict
+        or leave the bounds of the fluents, as in the UP simulator."""
+        updated: Dict[int, Any] = {}
+        assigned = set()
+        for condition, i, kind, value, is_bool in self.effects:
+            if condition is not None and not condition(values):
+                continue
+            new_value = value(values)
+            if kind == _ASSIGN:
+                if i in updated:
+                    old_value = updated[i]
+                    if new_value != old_value:
+                        if not is_bool:
+                            return None
+                        elif not old_value:
+                            # add-after-delete
+                            updated[i] = new_value
+                        continue
+                    elif i not in assigned:
+                        return None
+                assigned.add(i)
+                updated[i] = new_value
+            else:
+                if i in assigned:
+                    return None
+                old_value = updated[i] if i in updated else values[i]
+                updated[i] = (
+                    old_value + new_value
+                    if kind == _INCREASE
+                    else old_value - new_value
+                )
+        next_values = list(values)
+        for i, new_value in updated.items():
+            bounds = self._bounds[i]
+            if bounds is not None and (
+                (bounds[0] is not None and new_value < bounds[0])
+                or (bounds[1] is not None and new_value > bounds[1])
+            ):
+                return None
+            next_values[i] = self._encoders[i](new_value)
+        return tuple(next_values)
+
+
+class _ExpressionCompiler:
+    """Compiles the UP expressions of a problem into closures over the tuples
+    of the encoded values of its non-static fluents, folding the static
+    fluents. Boolean values are encoded as 0 or 1, integers as themselves and
+    objects as their index in the objects of the type of the fluent."""
+
+    def __init__(
+        self,
+        problem: "up.model.Problem",
+        fluents: Sequence[FNode],
+        static_values: Dict[FNode, FNode],
+        total_cost: Optional[FNode] = None,
+    ):
+        """
+        :param problem: The UP problem of the expressions.
+        :param fluents: The non-static fluents, in the order of the values.
+        :param static_values: The values of the static fluents.
+        :param total_cost: The 'total-cost' fluent, whose increases are compiled
+            as the costs of the actions, if any.
+        """
+        self._problem = problem
+        self._em = problem.environment.expression_manager
+        self._index = {fn: i for i, fn in enumerate(fluents)}
+        self._static_values = static_values
+        self._is_bool: List[bool] = []
+        self._objects: List[Optional[List["up.model.Object"]]] = []
+        self.encoders: List[Callable[[Any], Any]] = []
+        self.bounds: List[Optional[Tuple[Optional[int], Optional[int]]]] = []
+        for fn in fluents:
+            fluent_type = fn.fluent().type
+            self._is_bool.append(fluent_type.is_bool_type())
+            if fluent_type.is_user_type():
+                objects = list(problem.objects(fluent_type))
+                indices = {o: i for i, o in enumerate(objects)}
+                self._objects.append(objects)
+                self.encoders.append(indices.__getitem__)
+            else:
+                self._objects.append(None)
+                self.encoders.append(int)
+            self.bounds.append(
+                (fluent_type.lower_bound, fluent_type.upper_bound)
+                if fluent_type.is_int_type()
+                and (
+                    fluent_type.lower_bound is not None
+                    or fluent_type.upper_bound is not None
+                )
+                else None
+            )
+        self._total_cost = total_cost
+
+    def compile_condition(
+        self, conditions: Sequence[FNode]
+    ) -> Optional[Callable[[Values], bool]]:
+        """Returns the closure of the conjunction of the conditions, or None if
+        they cannot be compiled."""
+        try:
+            return self._compile(self._em.And(conditions))
+        except _NotCompiled:
+            return None
+
+    def compile_action(
+        self, action: "up.model.InstantaneousAction"
+    ) -> Optional[_CompiledAction]:
+        """Returns the compiled ground action, or None if it cannot be compiled
+        (e.g. if it has a simulated effect or a forall effect)."""
+        if action.simulated_effect is not None:
+            return None
+        try:
+            precondition = self._compile(self._em.And(action.preconditions))
+            effects = []
+            costs = []
+            for effect in action.effects:
+                if effect.is_forall():
+                    raise _NotCompiled(effect)
+                condition = (
+                    self._compile(effect.condition) if effect.is_conditional() else None
+                )
+                value = self._compile(effect.value)
+                kind = (
+                    _INCREASE
+                    if effect.is_increase()
+                    else _DECREASE if effect.is_decrease() else _ASSIGN
+                )
+                if effect.fluent == self._total_cost and kind != _ASSIGN:
+                    costs.append((condition, kind, value))
+                    continue
+                i = self._index.get(effect.fluent, None)
+                if i is None:
+                    raise _NotCompiled(effect)
+                effects.append((condition, i, kind, value, self._is_bool[i]))
+        except _NotCompiled:
+            return None
+        return _CompiledAction(
+            precondition, effects, _compile_cost(costs), self.encoders, self.bounds
+        )
+
+    def compile_linear_condition(
+        self, conditions: Sequence[FNode]
+    ) -> Optional[List[Tuple[Dict[int, int], int]]]:
+        """Returns the rows (coefficients, bound) of the constraints
+        `coefficients . values <= bound` equivalent to the conjunction of the
+        conditions, or None if it is not linear."""
+        rows: List[Tuple[Dict[int, int], int]] = []
+        try:
+            for condition in conditions:
+                self._linear_constraints(condition, rows)
+        except _NotCompiled:
+            return None
+        return rows
+
+    def compile_linear_action(
+        self, action: "up.model.InstantaneousAction"
+    ) -> Optional[_LinearAction]:
+        """Returns the linear form of the ground action, or None if its
+        preconditions are not a conjunction of linear constraints over the
+        integer values of the fluents or if its effects are not unconditional
+        constant assignments, increases and decreases (or assignments of the
+        fluent plus a constant)."""
+        if action.simulated_effect is not None:
+            return None
+        try:
+            rows: List[Tuple[Dict[int, int], int]] = []
+            for precondition in action.preconditions:
+                self._linear_constraints(precondition, rows)
+            # the assigned values, and whether they are shifts of the old values
+            assignments: Dict[int, Tuple[bool, int]] = {}
+            increases: Dict[int, int] = {}
+            cost = 0
+            for effect in action.effects:
+                if effect.is_forall() or effect.is_conditional():
+                    raise _NotCompiled(effect)
+                if effect.fluent == self._total_cost and not effect.is_assignment():
+                    value = self._linear(effect.value)
+                    if len(value[0]) > 0:
+                        raise _NotCompiled(effect)
+                    cost += value[1] if effect.is_increase() else -value[1]
+                    continue
+                i = self._index.get(effect.fluent, None)
+                if i is None:
+                    raise _NotCompiled(effect)
+                if effect.is_assignment():
+                    try:
+                        value = (False, self._constant_code(effect.value, i))
+                    except _NotCompiled:
+                        # assignments like x := x + c are shifts of the value
+                        coefficients, constant = self._linear(effect.value)
+                        if coefficients != {i: 1}:
+                            raise
+                        value = (True, constant)
+                    if i in increases:
+                        raise _NotCompiled(effect)
+                    elif i in assignments and assignments[i] != value:
+                        if not self._is_bool[i]:
+                            raise _NotCompiled(effect)
+                        # add-after-delete
+                        value = (False, 1)
+                    assignments[i] = value
+                else:
+                    value = self._constant_code(effect.value, i)
+                    if i in assignments:
+                        raise _NotCompiled(effect)
+                    increases[i] = increases.get(i, 0) + (
+                        value if effect.is_increase() else -value
+                    )
+        except _NotCompiled:
+            return None
+        for i, (shift, value) in list(assignments.items()):
+            if shift:
+                increases[i] = value
+                del assignments[i]
+        # the UP simulator checks the bounds of the updated fluents
+        for i, (_, value) in assignments.items():
+            lb, ub = self.bounds[i] or (None, None)
+            if (lb is not None and value < lb) or (ub is not None and value > ub):
+                rows.append(({}, -1))
+        for i, delta in increases.items():
+            lb, ub = self.bounds[i] or (None, None)
+            if ub is not None:
+                rows.append(({i: 1}, ub - delta))
+            if lb is not None:
+                rows.append(({i: -1}, delta - lb))
+        assignments = {i: value for i, (_, value) in assignments.items()}
+        return rows, assignments, increases, cost
+
+    def _compile(self, expression: FNode) -> Callable[[Values], Any]:
+        if expression.is_bool_constant():
+            return _constant(expression.bool_constant_value())
+        elif expression.is_int_constant() or expression.is_real_constant():
+            return _constant(expression.constant_value())
+        elif expression.is_object_exp():
+            return _constant(expression.object())
+        elif expression.is_fluent_exp():
+            if expression in self._static_values:
+                return self._compile(self._static_values[expression])
+            i = self._index.get(expression, None)
+            if i is None:
+                # e.g. fluents with fluent arguments, or the total cost
+                raise _NotCompiled(expression)
+            objects = self._objects[i]
+            if objects is not None:
+                return lambda v: objects[v[i]]
+            return lambda v: v[i]
+        elif expression.is_exists() or expression.is_forall():
+            return self._compile_quantifier(expression)
+        args = [self._compile(a) for a in expression.args]
+        if expression.is_and():
+            return _all(args)
+        elif expression.is_or():
+            return _any(args)
+        elif expression.is_not():
+            a = args[0]
+            return lambda v: not a(v)
+        elif expression.is_implies():
+            a, b = args
+            return lambda v: not a(v) or b(v)
+        elif expression.is_iff():
+            a, b = args
+            return lambda v: bool(a(v)) == bool(b(v))
+        elif expression.is_equals():
+            a, b = args
+            return lambda v: a(v) == b(v)
+        elif expression.is_le():
+            a, b = args
+            return lambda v: a(v) <= b(v)
+        elif expression.is_lt():
+            a, b = args
+            return lambda v: a(v) < b(v)
+        elif expression.is_plus():
+            return lambda v: sum(a(v) for a in args)
+        elif expression.is_minus():
+            a, b = args
+            return lambda v: a(v) - b(v)
+        elif expression.is_times():
+
+            def times(v):
+                result = 1
+                for a in args:
+                    result *= a(v)
+                return result
+
+            return times
+        elif expression.is_div():
+            a, b = args
+            return lambda v: Fraction(a(v)) / b(v)
+        raise _NotCompiled(expression)
+
+    def _linear(self, expression: FNode) -> Tuple[Dict[int, int], int]:
+        """Returns the coefficients of the fluents and the constant of a linear
+        integer expression."""
+        if expression.is_bool_constant():
+            return {}, int(expression.bool_constant_value())
+        elif expression.is_int_constant():
+            return {}, expression.int_constant_value()
+        elif expression.is_real_constant():
+            value = expression.real_constant_value()
+            if value.denominator != 1:
+                raise _NotCompiled(expression)
+            return {}, int(value)
+        elif expression.is_fluent_exp():
+            if expression in self._static_values:
+                return self._linear(self._static_values[expression])
+            i = self._index.get(expression, None)
+            if i is None or self._objects[i] is not None:
+                raise _NotCompiled(expression)
+            return {i: 1}, 0
+        elif expression.is_plus() or expression.is_minus():
+            coefficients: Dict[int, int] = {}
+            constant = 0
+            for k, arg in enumerate(expression.args):
+                sign = -1 if expression.is_minus() and k > 0 else 1
+                arg_coefficients, arg_constant = self._linear(arg)
+                for i, c in arg_coefficients.items():
+                    coefficients[i] = coefficients.get(i, 0) + sign * c
+                constant += sign * arg_constant
+            return coefficients, constant
+        elif expression.is_times():
+            coefficients, constant = {}, 1
+            for arg in expression.args:
+                arg_coefficients, arg_constant = self._linear(arg)
+                if len(arg_coefficients) == 0:
+                    coefficients = {
+                        i: c * arg_constant for i, c in coefficients.items()
+                    }
+                    constant *= arg_constant
+                elif len(coefficients) == 0:
+                    coefficients = {
+                        i: c * constant for i, c in arg_coefficients.items()
+                    }
+                    constant *= arg_constant
+                else:
+                    raise _NotCompiled(expression)
+            return coefficients, constant
+        raise _NotCompiled(expression)
+
+    def _linear_constraints(
+        self, expression: FNode, rows: List[Tuple[Dict[int, int], int]]
+    ):
+        """Appends the rows (coefficients, bound) of the constraints
+        `coefficients . values <= bound` equivalent to the expression."""
+        if expression.is_and():
+            for arg in expression.args:
+                self._linear_constraints(arg, rows)
+            return
+        negated = expression.is_not()
+        if negated:
+            expression = expression.arg(0)
+        if expression.is_bool_constant() or expression.is_fluent_exp():
+            value = self._linear(expression)
+            if len(value[0]) == 0:
+                if bool(value[1]) == negated:
+                    rows.append(({}, -1))
+            else:
+                # the value is at least 1 if true, at most 0 if false
+                (i,) = value[0]
+                rows.append(({i: 1}, 0) if negated else ({i: -1}, -1))
+        elif expression.is_le() or expression.is_lt():
+            a, b = expression.args
+            if negated:
+                a, b = b, a
+            # a - b <= 0 (or <= -1 if strict)
+            coefficients, constant = self._linear(self._em.Minus(a, b))
+            strict = expression.is_lt() != negated
+            rows.append((coefficients, -constant - (1 if strict else 0)))
+        elif expression.is_equals() and not negated:
+            coefficients, constant = self._equality(*expression.args)
+            rows.append((coefficients, -constant))
+            rows.append(({i: -c for i, c in coefficients.items()}, constant))
+        else:
+            raise _NotCompiled(expression)
+
+    def _equality(self, a: FNode, b: FNode) -> Tuple[Dict[int, int], int]:
+        """Returns the linear form of `a - b`, whose value is 0 iff a equals b,
+        with the objects replaced by their index in the type of the fluent."""
+        if a.type.is_user_type():
+            if not a.is_fluent_exp() or a in self._static_values:
+                a, b = b, a
+            i = self._index.get(a, None) if a.is_fluent_exp() else None
+            if i is None:
+                raise _NotCompiled(a)
+            if b.is_fluent_exp() and b not in self._static_values:
+                j = self._index.get(b, None)
+                if j is None or self._objects[j] != self._objects[i]:
+                    raise _NotCompiled(b)
+                return {i: 1, j: -1}, 0
+            try:
+                return {i: 1}, -self._constant_code(b, i)
+            except KeyError:
+                # an object not in the type of the fluent, which is never equal
+                return {}, 1
+        coefficients, constant = self._linear(self._em.Minus(a, b))
+        return coefficients, constant
+
+    def _constant_code(self, expression: FNode, i: int) -> int:
+        """Returns the code of a constant expression in the values of fluent i."""
+        if expression.is_fluent_exp() and expression in self._static_values:
+            expression = self._static_values[expression]
+        if expression.is_object_exp():
+            return self.encoders[i](expression.object())
+        coefficients, constant = self._linear(expression)
+        if len(coefficients) > 0:
+            raise _NotCompiled(expression)
+        return constant
+
+    def _compile_quantifier(self, expression: FNode) -> Callable[[Values], bool]:
+        """Compiles the quantified expression as the conjunction or disjunction
+        of its body for all the objects of the variables."""
+        variables = expression.variables()
+        bodies = [
+            self._compile(
+                expression.arg(0).substitute(
+                    {var: self._em.ObjectExp(o) for var, o in zip(variables, objects)}
+                )
+            )
+            for objects in product(*(self._problem.objects(v.type) for v in variables))
+        ]
+        return _all(bodies) if expression.is_forall() else _any(bodies)
+
+
+def _constant(value: Any) -> Callable[[Values], Any]:
+    return lambda v: value
+
+
+def _all(args: List[Callable[[Values], Any]]) -> Callable[[Values], bool]:
+    if len(args) == 1:
+        a = args[0]
+        return lambda v: bool(a(v))
+
+    def conjunction(v):
+        for a in args:
+            if not a(v):
+                return False
+        return True
+
+    return conjunction
+
+
+def _any(args: List[Callable[[Values], Any]]) -> Callable[[Values], bool]:
+    def disjunction(v):
+        for a in args:
+            if a(v):
+                return True
+        return False
+
+    return disjunction
+
+
+def _compile_cost(
+    costs: List[Tuple[Optional[Callable], int, Callable]],
+) -> Callable[[Values], Any]:
+    def cost(v):
+        total = 0
+        for condition, kind, value in costs:
+            if condition is None or condition(v):
+                total += value(v) if kind == _INCREASE else -value(v)
+        return total
+
+    return cost
@@ -0,0 +1,106 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the state features used by the width-based solvers."""
+
+from typing import Any, Callable, Dict, List
+from weakref import WeakKeyDictionary
+import numpy as np
+from unified_planning.model import FNode
+from skdecide.hub.domain.up import UPDomain
+from up_skdecide.bitset import BitsetUPDomain
+from up_skdecide.numpy_state import NumpyUPDomain
+
+
+class _AtomFeatures:
+    """Feature extractor compiled for the non-static fluents of a domain. The
+    feature of each fluent is the code of its value, so that the novelty
+    tables of the solvers index the (fluent, value) atoms of the problem."""
+
+    def __init__(self, domain: UPDomain):
+        problem = domain._problem
+        static_fluents = problem.get_static_fluents()
+        self._fluents: List[FNode] = [
+            fn
+            for fn in problem.initial_values
+            if fn.fluent() not in static_fluents and fn.fluent().name != "total-cost"
+        ]
+        self._encoders: List[Callable[[FNode], int]] = []
+        for fn in self._fluents:
+            fluent_type = fn.fluent().type
+            if fluent_type.is_bool_type():
+                self._encoders.append(lambda v: int(v.bool_constant_value()))
+            elif fluent_type.is_int_type():
+                self._encoders.append(lambda v: v.int_constant_value())
+            elif fluent_type.is_user_type():
+                indices = {o: i for i, o in enumerate(problem.objects(fluent_type))}
+                self._encoders.append(lambda v, indices=indices: indices[v.object()])
+            else:
+                # the values of real fluents are numbered as they are reached
+                codes: Dict[Any, int] = {}
+                self._encoders.append(
+                    lambda v, codes=codes: codes.setdefault(
+                        v.constant_value(), len(codes)
+                    )
+                )
+        if isinstance(domain, BitsetUPDomain):
+            self._features = self._bitset_features
+            self._value_encoders = [
+                self._encoders[self._fluents.index(fn)] for fn in domain._value_fluents
+            ]
+        elif isinstance(domain, NumpyUPDomain):
+            self._features = lambda d, s: np.fromiter(s, dtype=np.int64, count=len(s))
+        elif domain._state_encoding == "vector":
+            self._features = lambda d, s: s
+        else:
+            self._features = self._up_features
+
+    def _bitset_features(self, domain: BitsetUPDomain, state) -> np.ndarray:
+        bits = state.bits
+        features = [(bits >> i) & 1 for i in range(len(domain._atoms))]
+        features.extend(
+            encode(v) for encode, v in zip(self._value_encoders, state.values)
+        )
+        return np.array(features, dtype=np.int64)
+
+    def _up_features(self, domain: UPDomain, state) -> np.ndarray:
+        up_state = domain._convert_to_skup_state_(state).up_state
+        return np.fromiter(
+            (
+                encode(up_state.get_value(fn))
+                for fn, encode in zip(self._fluents, self._encoders)
+            ),
+            dtype=np.int64,
+            count=len(self._fluents),
+        )
+
+    def __call__(self, domain: UPDomain, state) -> np.ndarray:
+        return self._features(domain, state)
+
+
+_compiled_features: "WeakKeyDictionary[UPDomain, _AtomFeatures]" = WeakKeyDictionary()
+
+
+def atom_features(domain: UPDomain, state) -> np.ndarray:
+    """Returns the int vector of the values of the non-static fluents in the
+    given state (Boolean values, integer values, object indices and numbers
+    of the reached real values), whatever the state encoding of the domain.
+
+    This is the default `state_features` of the solvers that require it, like
+    IW: their novelty tables then directly index the atoms of the problem.
+    """
+    features = _compiled_features.get(domain, None)
+    if features is None:
+        features = _compiled_features[domain] = _AtomFeatures(domain)
+    return features(domain, state)
@@ -0,0 +1,433 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the NumPy encoding of the UPDomain states."""
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import unified_planning as up
+from unified_planning.model import FNode, UPState
+from skdecide.core import EmptySpace, Value
+from skdecide.hub.domain.up import SkUPAction, SkUPState, UPDomain
+from skdecide.hub.space.gym import SetSpace
+from up_skdecide.bitset import _GroundAction
+from up_skdecide.expressions import _CompiledAction, _ExpressionCompiler
+from up_skdecide.vectorized import _LinearActions, _LinearCondition
+
+
+class NumpyState:
+    """State stored as the raw buffer of a NumPy record with one field per
+    fluent, which is hashed once and compared with a single memory comparison."""
+
+    __slots__ = ("_buffer", "_dtype", "_hash")
+
+    def __init__(self, buffer: bytes, dtype: np.dtype):
+        self._buffer = buffer
+        self._dtype = dtype
+        self._hash = hash(buffer)
+
+    @property
+    def array(self) -> np.ndarray:
+        """The read-only record of the state, sharing its buffer."""
+        return np.frombuffer(self._buffer, dtype=self._dtype)[0]
+
+    def __len__(self) -> int:
+        return len(self._dtype.names)
+
+    def __getitem__(self, index: int):
+        return self.array.item()[index]
+
+    def __iter__(self):
+        return iter(self.array.item())
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, NumpyState) and self._buffer == other._buffer
+
+    def __getstate__(self):
+        return (self._buffer, self._dtype)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self) -> str:
+        return "NumpyState({})".format(self.array.item())
+
+
+class NumpyUPDomain(UPDomain):
+    """UPDomain whose states are NumpyState instances, with the smallest dtype
+    able to hold each fluent: uint8 for Boolean fluents, the smallest integer
+    type containing the bounds of integer fluents (int64 if unbounded) and the
+    index of the object for fluents of user types.
+
+    The preconditions, effects and goals are compiled once into closures over
+    the values of the states. The actions which cannot be compiled (like those
+    with simulated effects), the problems with trajectory constraints and the
+    quality metrics other than the 'total-cost' fluent are handled by the UP
+    simulator on the equivalent UP states. Real fluents are not supported.
+
+    The actions whose preconditions are conjunctions of linear constraints and
+    whose effects are constant assignments, increases and decreases are also
+    compiled into matrices, which evaluate all these actions on a state, or a
+    batch of actions on a batch of states, with a few NumPy operations (see
+    `applicable_mask`, `next_values`, `transition_costs` and `goal_mask`).
+    """
+
+    def __init__(
+        self,
+        problem: "up.model.Problem",
+        fluent_domains: Optional[Dict] = None,
+        action_encoding: str = "native",
+        **simulator_params
+    ):
+        """
+        :param problem: The UP problem to wrap.
+        :param fluent_domains: The min and max values of the fluents, as in UPDomain.
+        :param action_encoding: The encoding of the actions, as in UPDomain.
+        :param simulator_params: The parameters of the UP sequential simulator.
+        """
+        self._ground_actions = None
+        super().__init__(
+            problem,
+            fluent_domains=fluent_domains,
+            state_encoding="native",
+            action_encoding=action_encoding,
+            **simulator_params
+        )
+        self._state_encoding = "numpy"
+        em = self._problem.environment.expression_manager
+        static_fluents = self._problem.get_static_fluents()
+        self._static_values: Dict[FNode, FNode] = {}
+        self._fluents: List[FNode] = []
+        fields: List[Tuple[str, np.dtype]] = []
+        self._encoders: List[Callable[[FNode], int]] = []
+        self._decoders: List[Callable[[int], FNode]] = []
+        for fn, value in self._problem.initial_values.items():
+            if fn.fluent().name == "total-cost":
+                continue
+            elif fn.fluent() in static_fluents:
+                self._static_values[fn] = value
+                continue
+            fluent_type = fn.fluent().type
+            if fluent_type.is_bool_type():
+                dtype = np.dtype(np.uint8)
+                self._encoders.append(lambda v: int(v.bool_constant_value()))
+                self._decoders.append(lambda i, nodes=(em.FALSE(), em.TRUE()): nodes[i])
+            elif fluent_type.is_int_type():
+                lb, ub = self._fluent_bounds(fn)
+                dtype = (
+                    np.dtype(np.int64)
+                    if lb is None or ub is None
+                    else np.promote_types(
+                        np.min_scalar_type(lb), np.min_scalar_type(ub)
+                    )
+                )
+                self._encoders.append(lambda v: v.int_constant_value())
+                self._decoders.append(em.Int)
+            elif fluent_type.is_user_type():
+                objects = list(self._problem.objects(fluent_type))
+                dtype = np.min_scalar_type(max(len(objects) - 1, 0))
+                indices = {o: i for i, o in enumerate(objects)}
+                nodes = [em.ObjectExp(o) for o in objects]
+                self._encoders.append(lambda v, indices=indices: indices[v.object()])
+                self._decoders.append(lambda i, nodes=nodes: nodes[i])
+            else:
+                raise RuntimeError(
+                    "Fluent {} of type {} not handled by the 'numpy' state encoding".format(
+                        fn, fluent_type
+                    )
+                )
+            fields.append(("f{}".format(len(self._fluents)), dtype))
+            self._fluents.append(fn)
+        self._dtype = np.dtype(fields)
+        self._total_cost_value = (
+            None
+            if self._total_cost is None
+            else self._problem.initial_values[self._total_cost]
+        )
+        self._init_action_encoding_()
+        compiler = _ExpressionCompiler(
+            self._problem, self._fluents, self._static_values, self._total_cost
+        )
+        # the UP simulator also checks the state invariants of the trajectory constraints
+        self._constrained = len(self._problem.trajectory_constraints) > 0
+        self._compiled_actions: List[Optional[_CompiledAction]] = [
+            None if self._constrained else compiler.compile_action(a._up_action)
+            for a in self._ground_actions
+        ]
+        # matrix form of the linear actions, only built for the batch operations
+        self._linear_actions: Optional[_LinearActions] = None
+        self._linear_positions: Optional[np.ndarray] = None
+        self._other_actions: Optional[List[_GroundAction]] = None
+        self._compile_goals(compiler)
+
+    def _compile_goals(self, compiler: Optional[_ExpressionCompiler] = None):
+        """Compiles the goals of the problem, again whenever they change."""
+        if compiler is None:
+            compiler = _ExpressionCompiler(
+                self._problem, self._fluents, self._static_values, self._total_cost
+            )
+        self._compiled_goal = compiler.compile_condition(self._problem.goals)
+        linear_goal = compiler.compile_linear_condition(self._problem.goals)
+        self._linear_goal = (
+            None if linear_goal is None else _LinearCondition(linear_goal)
+        )
+
+    def _vectorize(self):
+        """Builds the matrix form of the linear actions on the first batch
+        operation, the search over single states using the compiled closures."""
+        if self._linear_actions is not None:
+            return
+        compiler = _ExpressionCompiler(
+            self._problem, self._fluents, self._static_values, self._total_cost
+        )
+        linear_actions = []
+        if not self._constrained:
+            for a in self._ground_actions:
+                linear = compiler.compile_linear_action(a._up_action)
+                if linear is not None:
+                    linear_actions.append((a.index, linear))
+        positions = np.full(len(self._ground_actions), -1, dtype=np.int64)
+        positions[[i for i, _ in linear_actions]] = np.arange(len(linear_actions))
+        self._other_actions = [
+            a for a in self._ground_actions if positions[a.index] < 0
+        ]
+        self._linear_positions = positions
+        self._linear_actions = _LinearActions(linear_actions)
+
+    @staticmethod
+    def _fluent_bounds(fn: FNode) -> Tuple[Optional[int], Optional[int]]:
+        """Returns the bounds of the type of a fluent, which its values cannot
+        leave, unlike its fluent domain which only serves the observation
+        spaces of UPDomain."""
+        return fn.fluent().type.lower_bound, fn.fluent().type.upper_bound
+
+    def _pack(self, values: Tuple) -> NumpyState:
+        return NumpyState(np.array([values], dtype=self._dtype).tobytes(), self._dtype)
+
+    def values_array(self, states: Sequence[NumpyState]) -> np.ndarray:
+        """Returns the int64 matrix of the values of the given states, with one
+        row per state and one column per non-static fluent."""
+        records = np.frombuffer(
+            b"".join(s._buffer for s in states), dtype=self._dtype, count=len(states)
+        )
+        values = np.empty((len(states), len(self._fluents)), dtype=np.int64)
+        for j, name in enumerate(self._dtype.names):
+            values[:, j] = records[name]
+        return values
+
+    def states_from_array(self, values: np.ndarray) -> List[NumpyState]:
+        """Returns the states of the rows of a matrix of values."""
+        records = np.empty(len(values), dtype=self._dtype)
+        for j, name in enumerate(self._dtype.names):
+            records[name] = values[:, j]
+        buffer = records.tobytes()
+        size = self._dtype.itemsize
+        return [
+            NumpyState(buffer[i : i + size], self._dtype)
+            for i in range(0, len(buffer), size)
+        ]
+
+    def applicable_mask(self, values: np.ndarray) -> np.ndarray:
+        """Returns the Boolean matrix whose element (i, j) tells whether the
+        ground action of index j (its 'int' encoding) is applicable in the
+        state of the i-th row of the matrix of values."""
+        values = np.asarray(values, dtype=np.int64)
+        self._vectorize()
+        mask = np.zeros((len(values), len(self._ground_actions)), dtype=bool)
+        mask[:, self._linear_actions.indices] = self._linear_actions.applicable(values)
+        if len(self._other_actions) > 0:
+            for row, memory in zip(mask, self.states_from_array(values)):
+                for action in self._applicable(memory, self._other_actions):
+                    row[action.index] = True
+        return mask
+
+    def next_values(self, values: np.ndarray, actions: np.ndarray) -> np.ndarray:
+        """Returns the matrix of the values of the successors of the states of
+        the rows of values by the ground actions of the given indices (one per
+        row), which must be applicable."""
+        values = np.asarray(values, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        self._vectorize()
+        positions = self._linear_positions[actions]
+        linear = positions >= 0
+        next_values = np.empty_like(values)
+        next_values[linear] = self._linear_actions.apply(
+            values[linear], positions[linear]
+        )
+        others = np.flatnonzero(~linear)
+        if len(others) > 0:
+            states = self.states_from_array(values[others])
+            next_values[others] = self.values_array(
+                [
+                    self._get_next_state(
+                        memory,
+                        self._convert_from_skup_action_(self._ground_actions[a]),
+                    )
+                    for memory, a in zip(states, actions[others])
+                ]
+            )
+        return next_values
+
+    def goal_mask(self, values: np.ndarray) -> np.ndarray:
+        """Returns the Boolean vector of the rows of values which are goal
+        states."""
+        values = np.asarray(values, dtype=np.int64)
+        if self._linear_goal is not None:
+            return self._linear_goal(values)
+        return np.array(
+            [self._is_terminal(memory) for memory in self.states_from_array(values)],
+            dtype=bool,
+        )
+
+    def transition_costs(
+        self, values: np.ndarray, actions: np.ndarray, next_values: np.ndarray
+    ) -> np.ndarray:
+        """Returns the vector of the costs of the transitions from the rows of
+        values to the rows of next_values by the ground actions of the given
+        indices, which are unit costs if the problem has neither a 'total-cost'
+        fluent nor quality metrics."""
+        values = np.asarray(values, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        if self._total_cost is None and len(self._problem.quality_metrics) == 0:
+            return np.ones(len(values))
+        costs = np.empty(len(values))
+        self._vectorize()
+        positions = self._linear_positions[actions]
+        linear = positions >= 0
+        if self._total_cost is None:
+            linear[:] = False
+        costs[linear] = self._linear_actions.costs[positions[linear]]
+        others = np.flatnonzero(~linear)
+        if len(others) > 0:
+            states = self.states_from_array(values[others])
+            next_states = self.states_from_array(np.asarray(next_values)[others])
+            for r, memory, next_memory in zip(others, states, next_states):
+                action = self._convert_from_skup_action_(
+                    self._ground_actions[actions[r]]
+                )
+                costs[r] = self._get_transition_value(memory, action, next_memory).cost
+        return costs
+
+    def _init_action_encoding_(self):
+        if self._ground_actions is None:
+            self._ground_actions = [
+                _GroundAction(i, grounded, action, parameters)
+                for i, (action, parameters, grounded) in enumerate(
+                    a for a in self._grounder.get_grounded_actions() if a[2] is not None
+                )
+            ]
+            self._actions_np2up = self._ground_actions
+            self._actions_up2np = {a: a.index for a in self._ground_actions}
+
+    def _convert_to_skup_action_(self, action):
+        if self._action_encoding == "int":
+            return self._ground_actions[int(action)]
+        return action
+
+    def _convert_from_skup_action_(self, skup_action: SkUPAction):
+        if self._action_encoding == "int":
+            if isinstance(skup_action, _GroundAction):
+                return skup_action.index
+            return self._actions_up2np[skup_action]
+        return skup_action
+
+    def _convert_to_skup_state_(self, state: NumpyState):
+        if state is None:
+            return None
+        values = dict(self._static_values)
+        for fn, decode, v in zip(self._fluents, self._decoders, state):
+            values[fn] = decode(v)
+        if self._total_cost is not None:
+            # transition costs only depend on the difference of total costs
+            values[self._total_cost] = self._total_cost_value
+        return SkUPState(UPState(values))
+
+    def _convert_from_skup_state_(self, skup_state: SkUPState) -> NumpyState:
+        up_state = skup_state.up_state
+        record = tuple(
+            encode(up_state.get_value(fn))
+            for fn, encode in zip(self._fluents, self._encoders)
+        )
+        return self._pack(record)
+
+    def _get_observation_space_(self):
+        raise RuntimeError("Observation space not defined for state encoding 'numpy'")
+
+    def _get_next_state(self, memory: NumpyState, action) -> NumpyState:
+        ground_action = self._convert_to_skup_action_(action)
+        compiled = self._compiled_actions[ground_action.index]
+        if compiled is None:
+            return super()._get_next_state(memory, action)
+        values = compiled.apply(memory.array.item())
+        if values is None:
+            raise RuntimeError(
+                "Action {} is not applicable in state {}".format(ground_action, memory)
+            )
+        return self._pack(values)
+
+    def _get_transition_value(
+        self, memory: NumpyState, action, next_state: Optional[NumpyState] = None
+    ) -> Value:
+        compiled = self._compiled_actions[self._convert_to_skup_action_(action).index]
+        if compiled is not None and self._total_cost is not None:
+            return Value(cost=compiled.cost(memory.array.item()))
+        return super()._get_transition_value(memory, action, next_state)
+
+    def _is_terminal(self, memory: NumpyState) -> bool:
+        if self._compiled_goal is None:
+            return super()._is_terminal(memory)
+        return self._compiled_goal(memory.array.item())
+
+    def _is_applicable_action(self, memory: NumpyState, action) -> bool:
+        action = self._convert_to_skup_action_(action)
+        compiled = self._compiled_actions[action.index]
+        if compiled is not None:
+            return compiled.is_applicable(memory.array.item())
+        return self._simulator.is_applicable(
+            self._convert_to_skup_state_(memory).up_state,
+            action.up_action,
+            action.up_parameters,
+        )
+
+    def _applicable(
+        self, memory: NumpyState, actions: List[_GroundAction]
+    ) -> List[_GroundAction]:
+        """Returns the applicable actions among the given ones."""
+        values = memory.array.item()
+        up_state = None
+        applicable = []
+        for action in actions:
+            compiled = self._compiled_actions[action.index]
+            if compiled is not None:
+                if compiled.is_applicable(values):
+                    applicable.append(action)
+                continue
+            if up_state is None:
+                up_state = self._convert_to_skup_state_(memory).up_state
+            if self._simulator.is_applicable(
+                up_state, action.up_action, action.up_parameters
+            ):
+                applicable.append(action)
+        return applicable
+
+    def _get_applicable_actions_from(self, memory: NumpyState):
+        applicable = self._applicable(memory, self._ground_actions)
+        if len(applicable) == 0:
+            return EmptySpace()
+        if self._action_encoding == "int":
+            return SetSpace([a.index for a in applicable])
+        return SetSpace(applicable)
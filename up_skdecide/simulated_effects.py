@@ -0,0 +1,419 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the memoization and the parallel evaluation of the
+simulated effects."""
+
+from collections import OrderedDict
+from fractions import Fraction
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Set, Tuple, Union
+import weakref
+import numpy as np
+from pathos.helpers import mp
+import unified_planning as up
+from unified_planning.engines.sequential_simulator import UPSequentialSimulator
+from unified_planning.model import FNode, SimulatedEffect, State, UPState
+from skdecide.hub.domain.up import UPDomain
+
+
+class _RecordingState(State):
+    """State recording the fluents read through it."""
+
+    def __init__(self, state: State):
+        self._state = state
+        self.read: Dict[FNode, None] = {}
+
+    def get_value(self, value: FNode) -> FNode:
+        self.read[value] = None
+        return self._state.get_value(value)
+
+
+class SimulatedEffectCache:
+    """Cache of the values computed by the simulated effects of the ground
+    actions, keyed on the values of the fluents they read.
+
+    The fluents read by the simulated effect of each ground action are
+    recorded as it is evaluated, so that its functions must only depend on
+    the state (through `get_value`) and on the action parameters.
+    """
+
+    def __init__(self, max_size: int = 4096, eviction: str = "lru"):
+        """
+        :param max_size: The maximum number of cached evaluations.
+        :param eviction: The evicted evaluations when full: the least recently
+            used ones ("lru") or the oldest ones ("fifo").
+        """
+        if eviction not in ("lru", "fifo"):
+            raise RuntimeError("Eviction must be either 'lru' or 'fifo'")
+        self.max_size = max_size
+        self.eviction = eviction
+        self.hits = 0
+        self.misses = 0
+        self._values: "OrderedDict[Hashable, List[FNode]]" = OrderedDict()
+        # fluents read so far by the simulated effect of each ground action
+        self._reads: Dict[Hashable, Tuple[FNode, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def install(self, simulator: UPSequentialSimulator):
+        """Makes the given simulator use this cache for the simulated effects
+        of the ground actions it applies."""
+        if not isinstance(simulator, UPSequentialSimulator):
+            raise RuntimeError(
+                "Simulated effects can only be cached with a UPSequentialSimulator. Provided: {}".format(
+                    type(simulator).__name__
+                )
+            )
+        ground_action = simulator._grounder.ground_action
+        memoized: Set[Hashable] = set()
+
+        def memoizing_ground_action(action, parameters=tuple()):
+            grounded = ground_action(action, parameters)
+            key = (action, tuple(parameters))
+            if (
+                grounded is not None
+                and grounded.simulated_effect is not None
+                and key not in memoized
+            ):
+                memoized.add(key)
+                grounded._simulated_effect = self._memoize(
+                    key, grounded.simulated_effect
+                )
+            return grounded
+
+        simulator._grounder.ground_action = memoizing_ground_action
+
+    def _memoize(
+        self, key: Hashable, simulated_effect: SimulatedEffect
+    ) -> SimulatedEffect:
+        function = simulated_effect.function
+
+        def memoized_function(
+            problem: "up.model.AbstractProblem", state: State, parameters: Dict
+        ) -> List[FNode]:
+            reads = self._reads.get(key, ())
+            value_key = (key, reads, tuple(state.get_value(f) for f in reads))
+            values = self._values.get(value_key, None)
+            if values is not None:
+                self.hits += 1
+                if self.eviction == "lru":
+                    self._values.move_to_end(value_key)
+                return list(values)
+            self.misses += 1
+            recording_state = _RecordingState(state)
+            values = function(problem, recording_state, parameters)
+            if any(f not in reads for f in recording_state.read):
+                # the entries keyed on the previously read fluents are not hit
+                # anymore, but they are still valid and left to be evicted
+                reads = tuple(dict.fromkeys(reads + tuple(recording_state.read)))
+                self._reads[key] = reads
+            if self.max_size > 0:
+                value_key = (key, reads, tuple(state.get_value(f) for f in reads))
+                self._values[value_key] = list(values)
+                if len(self._values) > self.max_size:
+                    self._values.popitem(last=False)
+            return values
+
+        return SimulatedEffect(simulated_effect.fluents, memoized_function)
+
+
+def _to_constant(node: FNode) -> Union[bool, int, Fraction, str]:
+    """Returns the Python value of a constant, or the name of an object, which
+    can be sent to another process unlike the FNode."""
+    if node.is_bool_constant():
+        return node.bool_constant_value()
+    elif node.is_int_constant():
+        return node.int_constant_value()
+    elif node.is_real_constant():
+        return node.real_constant_value()
+    elif node.is_object_exp():
+        return node.object().name
+    raise RuntimeError("Value {} is not a constant".format(node))
+
+
+def _from_constant(
+    problem: "up.model.Problem", value: Union[bool, int, Fraction, str]
+) -> FNode:
+    em = problem.environment.expression_manager
+    if isinstance(value, bool):
+        return em.Bool(value)
+    elif isinstance(value, int):
+        return em.Int(value)
+    elif isinstance(value, Fraction):
+        return em.Real(value)
+    return em.ObjectExp(problem.object(value))
+
+
+# problem of the simulated effects evaluated by a worker process, with the
+# fluents whose values are sent to it
+_worker_problem: Optional["up.model.Problem"] = None
+_worker_fluents: List[FNode] = []
+
+
+def _init_effect_worker(problem: "up.model.Problem"):
+    global _worker_problem, _worker_fluents
+    _worker_problem = problem
+    _worker_fluents = list(problem.initial_values)
+
+
+def _evaluate_simulated_effect(
+    action_name: str, parameters: Tuple[Any, ...], values: Tuple[Any, ...]
+) -> List[Any]:
+    problem = _worker_problem
+    action = problem.action(action_name)
+    state = UPState(
+        {fn: _from_constant(problem, v) for fn, v in zip(_worker_fluents, values)}
+    )
+    actual_parameters = {
+        p: _from_constant(problem, v) for p, v in zip(action.parameters, parameters)
+    }
+    return [
+        _to_constant(v)
+        for v in action.simulated_effect.function(problem, state, actual_parameters)
+    ]
+
+
+# expression managers whose node creation is made thread-safe, with their
+# original node creation method and the number of pools using them
+_locked_managers: Dict["up.model.ExpressionManager", Tuple[Callable, int]] = {}
+_locked_managers_lock = threading.Lock()
+
+
+def _lock_node_creation(em: "up.model.ExpressionManager"):
+    """Makes the creation of the expressions thread-safe, since two threads
+    creating the same expression would otherwise get two distinct FNodes."""
+    with _locked_managers_lock:
+        if em in _locked_managers:
+            create_node, users = _locked_managers[em]
+            _locked_managers[em] = (create_node, users + 1)
+            return
+        lock = threading.RLock()
+        create_node = em.create_node
+
+        def locked_create_node(*args, **kwargs):
+            with lock:
+                return create_node(*args, **kwargs)
+
+        em.create_node = locked_create_node
+        _locked_managers[em] = (create_node, 1)
+
+
+def _unlock_node_creation(em: "up.model.ExpressionManager"):
+    """Restores the original creation of the expressions once no pool uses
+    the expression manager anymore."""
+    with _locked_managers_lock:
+        create_node, users = _locked_managers.pop(em)
+        if users > 1:
+            _locked_managers[em] = (create_node, users - 1)
+        else:
+            em.create_node = create_node
+
+
+def _stop_pool(
+    pool: "mp.pool.Pool", locked_manager: Optional["up.model.ExpressionManager"]
+):
+    """Stops the workers of a pool, restoring the node creation it locked."""
+    pool.terminate()
+    if locked_manager is not None:
+        _unlock_node_creation(locked_manager)
+
+
+def _state_key(memory) -> Hashable:
+    # the states of the 'vector' encoding are unhashable arrays
+    return memory.tobytes() if isinstance(memory, np.ndarray) else memory
+
+
+class SimulatedEffectPool:
+    """Pool of workers evaluating in parallel the simulated effects of all the
+    ground actions whose preconditions hold in a state, as soon as the
+    applicable actions of this state are requested. The applicability checks
+    of the UP simulator (which evaluate the simulated effects to check the
+    bounds of the fluents) and the transitions from this state then gather the
+    results instead of evaluating the simulated effects one at a time.
+
+    Worker processes receive the values of the fluents and the parameters as
+    Python constants and evaluate the simulated effects of their own copy of
+    the problem, which they get when forked. Worker threads directly evaluate
+    the simulated effects and only run in parallel if they release the GIL.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        executor: str = "process",
+        max_states: int = 64,
+    ):
+        """
+        :param workers: The number of workers, defaults to the number of CPUs.
+        :param executor: The workers evaluating the simulated effects: worker
+            processes ("process") or threads ("thread").
+        :param max_states: The maximum number of states whose evaluations are
+            kept for the transitions from them.
+        """
+        if executor not in ("process", "thread"):
+            raise RuntimeError("Executor must be either 'process' or 'thread'")
+        self.workers = workers
+        self.executor = executor
+        self.max_states = max_states
+        self._pool = None
+        # stops the workers when the pool is closed or garbage collected
+        self._finalizer: Optional[weakref.finalize] = None
+        self._problem: Optional["up.model.Problem"] = None
+        self._fluents: List[FNode] = []
+        # ground actions with a simulated effect, as (action, parameters) pairs
+        self._candidates: Optional[List[Tuple[Any, Tuple[FNode, ...]]]] = None
+        self._batches: "OrderedDict[Hashable, Dict[Hashable, Any]]" = OrderedDict()
+        # batch of the state whose successors are computed by each thread
+        self._local = threading.local()
+
+    def install(self, domain: UPDomain):
+        """Makes the given domain evaluate with this pool the simulated effects
+        of the ground actions in the states whose applicable actions it
+        computes."""
+        simulator = domain._simulator
+        if not isinstance(simulator, UPSequentialSimulator):
+            raise RuntimeError(
+                "Simulated effects can only be evaluated by workers with a UPSequentialSimulator. Provided: {}".format(
+                    type(simulator).__name__
+                )
+            )
+        self._problem = domain._problem
+        self._fluents = list(self._problem.initial_values)
+        ground_action = simulator._grounder.ground_action
+        substituted: Set[Hashable] = set()
+
+        def substituting_ground_action(action, parameters=tuple()):
+            grounded = ground_action(action, parameters)
+            key = (action, tuple(parameters))
+            if (
+                grounded is not None
+                and grounded.simulated_effect is not None
+                and key not in substituted
+            ):
+                substituted.add(key)
+                grounded._simulated_effect = self._substitute(
+                    key, grounded.simulated_effect
+                )
+            return grounded
+
+        simulator._grounder.ground_action = substituting_ground_action
+        get_applicable_actions_from = domain._get_applicable_actions_from
+        get_next_state = domain._get_next_state
+
+        def submitting_get_applicable_actions_from(memory):
+            self._local.batch = self._submit(domain, memory)
+            try:
+                return get_applicable_actions_from(memory)
+            finally:
+                self._local.batch = None
+
+        def gathering_get_next_state(memory, action):
+            self._local.batch = self._batches.get(_state_key(memory), None)
+            try:
+                return get_next_state(memory, action)
+            finally:
+                self._local.batch = None
+
+        domain._get_applicable_actions_from = submitting_get_applicable_actions_from
+        domain._get_next_state = gathering_get_next_state
+
+    def close(self):
+        """Stops the workers, which are started again if needed."""
+        if self._pool is not None:
+            self._finalizer()
+            self._pool = None
+        self._batches.clear()
+
+    def _get_pool(self):
+        if self._pool is None:
+            locked_manager = None
+            if self.executor == "process":
+                self._pool = mp.Pool(
+                    processes=self.workers,
+                    initializer=_init_effect_worker,
+                    initargs=(self._problem,),
+                )
+            else:
+                locked_manager = self._problem.environment.expression_manager
+                _lock_node_creation(locked_manager)
+                self._pool = mp.pool.ThreadPool(processes=self.workers)
+            self._finalizer = weakref.finalize(
+                self, _stop_pool, self._pool, locked_manager
+            )
+        return self._pool
+
+    def _submit(self, domain: UPDomain, memory) -> Dict[Hashable, Any]:
+        """Submits the evaluations of the simulated effects of the ground
+        actions whose preconditions hold in the given state."""
+        state_key = _state_key(memory)
+        batch = self._batches.get(state_key, None)
+        if batch is not None:
+            self._batches.move_to_end(state_key)
+            return batch
+        simulator = domain._simulator
+        if self._candidates is None:
+            self._candidates = [
+                (action, tuple(parameters))
+                for action, parameters, grounded in simulator._grounder.get_grounded_actions()
+                if grounded is not None and grounded.simulated_effect is not None
+            ]
+        up_state = domain._convert_to_skup_state_(memory).up_state
+        values = None
+        batch = {}
+        for action, parameters in self._candidates:
+            _, reason = simulator.get_unsatisfied_conditions(
+                up_state, action, parameters, early_termination=True
+            )
+            if reason is not None:
+                continue
+            if self.executor == "process":
+                if values is None:
+                    values = tuple(
+                        _to_constant(up_state.get_value(fn)) for fn in self._fluents
+                    )
+                result = self._get_pool().apply_async(
+                    _evaluate_simulated_effect,
+                    (action.name, tuple(_to_constant(p) for p in parameters), values),
+                )
+            else:
+                result = self._get_pool().apply_async(
+                    action.simulated_effect.function,
+                    (self._problem, up_state, dict(zip(action.parameters, parameters))),
+                )
+            batch[(action, parameters)] = result
+        self._batches[state_key] = batch
+        if len(self._batches) > self.max_states:
+            self._batches.popitem(last=False)
+        return batch
+
+    def _substitute(
+        self, key: Hashable, simulated_effect: SimulatedEffect
+    ) -> SimulatedEffect:
+        function = simulated_effect.function
+
+        def gathered_function(
+            problem: "up.model.AbstractProblem", state: State, parameters: Dict
+        ) -> List[FNode]:
+            batch = getattr(self._local, "batch", None)
+            result = None if batch is None else batch.get(key, None)
+            if result is None:
+                return function(problem, state, parameters)
+            values = result.get()
+            if self.executor == "process":
+                return [_from_constant(self._problem, v) for v in values]
+            return list(values)
+
+        return SimulatedEffect(simulated_effect.fluents, gathered_function)
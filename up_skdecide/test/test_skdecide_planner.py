@@ -1,9 +1,32 @@
+import os
+import threading
+import time
+import numpy as np
+import pytest
 from unified_planning.shortcuts import *
+from unified_planning.engines import (
+    FailedValidationReason,
+    PlanGenerationResultStatus,
+    ValidationResultStatus,
+)
+from unified_planning.engines.sequential_simulator import UPSequentialSimulator
 from unified_planning.test.examples import get_example_problems
 
-from skdecide.hub.domain.up import UPDomain as SkDecideDomain
+from pathos.helpers import mp
 
+from skdecide.hub.domain.up import SkUPAction, SkUPState, UPDomain as SkDecideDomain
+import skdecide.hub.domain.up.up as skdecide_up
+
+from skdecide.hub.solver.astar import Astar
 from skdecide.hub.solver.iw import IW
+from skdecide.solvers import DeterministicPolicySolver
+
+from up_skdecide import EngineImpl
+from up_skdecide.bitset import BitsetUPDomain
+from up_skdecide.domain_cache import DomainCache, _estimate_size, problem_key
+from up_skdecide.features import atom_features
+from up_skdecide.numpy_state import NumpyUPDomain
+from up_skdecide.vector_env import UPVectorEnv
 
 if "skdecide" not in get_environment().factory.engines:
     get_environment().factory.add_engine("skdecide", "up_skdecide", "EngineImpl")
@@ -25,9 +48,785 @@ def test_planner_basic():
         name="skdecide",
         params={
             "solver": IW,
-            "config": {"state_encoding": "vector", "state_features": lambda d, s: s},
+            "config": {"state_encoding": "vector"},
         },
     ) as planner:
         assert planner is not None
         res = planner.solve(problem)
         assert str(plan) == str(res.plan)
+        # the domain calls are only counted with detailed metrics
+        assert "next_state_calls" not in res.metrics
+
+
+def test_planner_plan_from_solver():
+    problem = problems["basic"].problem
+    plan = problems["basic"].valid_plans[0]
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "solver": Astar,
+            "config": {"state_encoding": "vector", "detailed_metrics": True},
+        },
+    ) as planner:
+        res = planner.solve(problem)
+        assert str(plan) == str(res.plan)
+        assert res.metrics["plan_extraction"] == "solver"
+        assert res.metrics["plan_length"] == "1"
+        assert int(res.metrics["next_state_calls"]) > 0
+        assert (
+            0
+            < int(res.metrics["generated_states"])
+            <= int(res.metrics["next_state_calls"])
+        )
+        assert "solve_time" in res.metrics
+
+
+def test_anytime_planner_basic_with_costs():
+    problem = problems["basic_with_costs"].problem
+    with AnytimePlanner(
+        name="skdecide",
+        params={
+            "solver": IW,
+            "config": {
+                "state_encoding": "vector",
+                "anytime_schedule": [{"time_budget": 0}, {"time_budget": 100}],
+            },
+        },
+    ) as planner:
+        results = list(planner.get_solutions(problem, timeout=10))
+        assert all(
+            r.status == PlanGenerationResultStatus.INTERMEDIATE for r in results[:-1]
+        )
+        assert results[-1].status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        assert str(results[-1].plan) == str(results[-2].plan)
+        assert results[-1].metrics is not results[-2].metrics
+
+
+def test_planner_progress_callback():
+    problem = problems["basic"].problem
+    results = []
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "solver": IW,
+            "config": {
+                "state_encoding": "vector",
+                "progress_callback": results.append,
+                "progress_interval": 0,
+            },
+        },
+    ) as planner:
+        planner.solve(problem)
+        assert len(results) > 0
+        assert all(r.status == PlanGenerationResultStatus.INTERMEDIATE for r in results)
+        assert "explored_states" in results[-1].metrics
+
+
+def test_portfolio_planner():
+    problem = problems["robot_fluent_of_user_type"].problem
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "portfolio": [
+                {
+                    "solver": IW,
+                    "config": {
+                        "state_encoding": "vector",
+                    },
+                },
+                {"solver": Astar, "config": {"state_encoding": "vector"}, "cores": 1},
+            ],
+            "portfolio_mode": "best",
+        },
+    ) as planner:
+        res = planner.solve(problem, timeout=60)
+        assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        assert res.metrics["portfolio_winner"] in ("0:IW", "1:Astar")
+        with PlanValidator(problem_kind=problem.kind) as validator:
+            assert (
+                validator.validate(problem, res.plan).status
+                == ValidationResultStatus.VALID
+            )
+
+
+class CrashingIW(IW):
+    """IW solver whose process dies while solving, as if killed by the OS."""
+
+    def _solve(self, *args, **kwargs):
+        os._exit(3)
+
+
+def test_portfolio_planner_crashed_member():
+    problem = problems["basic"].problem
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "portfolio": [
+                {"solver": CrashingIW, "config": {"state_encoding": "vector"}},
+                {"solver": CrashingIW, "config": {"state_encoding": "vector"}},
+            ]
+        },
+    ) as planner:
+        res = planner.solve(problem, timeout=60)
+        assert res.status == PlanGenerationResultStatus.INTERNAL_ERROR
+        assert "exited with code 3" in res.log_messages[0].message
+
+
+def test_batch_planner():
+    batch = [problems[name].problem for name in ("basic", "matchcellar", "robot")]
+    engine = EngineImpl(solver=IW, config={"state_encoding": "vector"})
+    # the workers keep the checks of the engine, and the general numeric
+    # planning of the robot problem is not declared as supported
+    engine.skip_checks = True
+    results = dict(engine.solve_batch(batch, workers=2, timeout=60))
+    assert sorted(results) == [0, 1, 2]
+    # the temporal problem fails without affecting the others
+    assert results[1].status == PlanGenerationResultStatus.INTERNAL_ERROR
+    for i in (0, 2):
+        assert results[i].status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        with PlanValidator(problem_kind=batch[i].kind) as validator:
+            assert (
+                validator.validate(batch[i], results[i].plan).status
+                == ValidationResultStatus.VALID
+            )
+
+
+def test_batch_planner_crashed_worker():
+    batch = [problems[name].problem for name in ("basic", "basic_conditional", "basic")]
+    engine = EngineImpl(solver=CrashingIW, config={"state_encoding": "vector"})
+    results = dict(engine.solve_batch(batch, workers=2, timeout=60))
+    assert sorted(results) == [0, 1, 2]
+    for result in results.values():
+        assert result.status == PlanGenerationResultStatus.INTERNAL_ERROR
+        assert "exited with code 3" in result.log_messages[0].message
+
+
+class SleepingIW(IW):
+    """IW solver ignoring the timeout, as if stuck in native code."""
+
+    def _solve(self, *args, **kwargs):
+        time.sleep(60)
+
+
+def test_batch_planner_hard_timeout():
+    batch = [problems[name].problem for name in ("basic", "basic_conditional")]
+    engine = EngineImpl(solver=SleepingIW, config={"state_encoding": "vector"})
+    start = time.perf_counter()
+    results = dict(engine.solve_batch(batch, workers=1, timeout=1))
+    # the worker is replaced for the second problem
+    assert time.perf_counter() - start < 20
+    assert sorted(results) == [0, 1]
+    for result in results.values():
+        assert result.status == PlanGenerationResultStatus.TIMEOUT
+    assert len(mp.active_children()) == 0
+
+
+def test_replanner():
+    problem = problems["basic_conditional"].problem
+    x, y = problem.fluent("x"), problem.fluent("y")
+    for encoding in ("vector", "bitset", "numpy"):
+        with Replanner(
+            problem=problem,
+            name="skdecide",
+            params={
+                "solver": IW,
+                "config": {"state_encoding": encoding},
+            },
+        ) as replanner:
+            res = replanner.resolve()
+            assert [a.action.name for a in res.plan.actions] == ["a_y", "a_x"]
+            replanner.update_initial_value(y, True)
+            res = replanner.resolve()
+            assert [a.action.name for a in res.plan.actions] == ["a_x"]
+            assert res.metrics["replanning_reuse"] == "solver"
+            replanner.remove_goal(x)
+            replanner.add_goal(y)
+            res = replanner.resolve()
+            assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+            assert len(res.plan.actions) == 0
+            assert res.metrics["replanning_reuse"] == "domain"
+            # the goals compiled by the domain follow the changes
+            replanner.add_goal(x)
+            res = replanner.resolve()
+            assert [a.action.name for a in res.plan.actions] == ["a_x"]
+
+
+def test_policy():
+    problem = problems["basic_conditional"].problem
+    engine = EngineImpl(solver=IW, config={"state_encoding": "vector"})
+    with engine.solve_policy(problem) as policy, SequentialSimulator(
+        problem
+    ) as simulator:
+        state = simulator.get_initial_state()
+        steps = 0
+        while not simulator.is_goal(state):
+            assert policy.is_defined_for(state) and steps < 2
+            state = simulator.apply(state, policy(state))
+            steps += 1
+        assert steps == 2
+
+
+def test_plan_validator():
+    problem = problems["basic_conditional"].problem
+    a_x, a_y = problem.action("a_x"), problem.action("a_y")
+    plans = [
+        up.plans.SequentialPlan([a_y(), a_x()]),
+        up.plans.SequentialPlan([a_y()]),
+        up.plans.SequentialPlan([a_y(), a_y()]),
+    ]
+    with PlanValidator(name="skdecide") as validator:
+        assert validator.validate(problem, plans[0]).status == (
+            ValidationResultStatus.VALID
+        )
+        results = validator.validate_batch(problem, plans)
+    assert [r.status for r in results] == [
+        ValidationResultStatus.VALID,
+        ValidationResultStatus.INVALID,
+        ValidationResultStatus.INVALID,
+    ]
+    assert results[1].reason == FailedValidationReason.UNSATISFIED_GOALS
+    assert results[2].reason == FailedValidationReason.INAPPLICABLE_ACTION
+    # the first action is simulated once for the three plans
+    assert sorted(r.metrics["reused_steps"] for r in results) == ["0", "1", "1"]
+
+
+def test_planner_timeout():
+    problem = problems["basic"].problem
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "solver": IW,
+            "config": {"state_encoding": "vector"},
+        },
+    ) as planner:
+        res = planner.solve(problem, timeout=0)
+        assert res.status == PlanGenerationResultStatus.TIMEOUT
+        assert res.plan is None
+        assert "engine_internal_time" in res.metrics
+
+
+def test_planner_timeout_during_search():
+    # 2^20 reachable states and an unreachable goal
+    problem = Problem("switches")
+    goal = Fluent("goal")
+    problem.add_fluent(goal, default_initial_value=False)
+    for i in range(20):
+        on = Fluent(f"on_{i}")
+        problem.add_fluent(on, default_initial_value=False)
+        switch = InstantaneousAction(f"switch_{i}")
+        switch.add_precondition(Not(on))
+        switch.add_effect(on, True)
+        problem.add_action(switch)
+    problem.add_goal(goal)
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "solver": Astar,
+            "config": {"state_encoding": "vector"},
+        },
+    ) as planner:
+        start = time.perf_counter()
+        res = planner.solve(problem, timeout=1)
+        assert time.perf_counter() - start < 10
+        assert res.status == PlanGenerationResultStatus.TIMEOUT
+        assert res.plan is None
+
+
+class FirstApplicableActionSolver(DeterministicPolicySolver):
+    T_domain = SkDecideDomain
+
+    def __init__(self, domain_factory):
+        DeterministicPolicySolver.__init__(self, domain_factory=domain_factory)
+        self._domain = domain_factory()
+
+    def _solve(self):
+        pass
+
+    def _get_next_action(self, observation, domain=None):
+        actions = self._domain.get_applicable_actions(observation).get_elements()
+        return next(iter(actions))
+
+    def _is_policy_defined_for(self, observation):
+        return True
+
+
+def test_planner_max_plan_length():
+    problem = problems["basic"].problem
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "solver": IW,
+            "config": {
+                "state_encoding": "vector",
+                "max_plan_length": 0,
+            },
+        },
+    ) as planner:
+        res = planner.solve(problem)
+        assert res.status == PlanGenerationResultStatus.UNSOLVABLE_INCOMPLETELY
+        assert res.plan is None
+
+
+def test_planner_cycling_policy():
+    x = Fluent("x")
+    y = Fluent("y")
+    toggle = InstantaneousAction("toggle")
+    toggle.add_effect(x, Not(x))
+    problem = Problem("cycle")
+    problem.add_fluent(x, default_initial_value=False)
+    problem.add_fluent(y, default_initial_value=False)
+    problem.add_action(toggle)
+    problem.add_goal(y)
+    with OneshotPlanner(
+        name="skdecide",
+        params={"solver": FirstApplicableActionSolver, "config": {}},
+    ) as planner:
+        res = planner.solve(problem)
+        assert res.status == PlanGenerationResultStatus.UNSOLVABLE_INCOMPLETELY
+        assert res.metrics["rollout_steps"] == "2"
+
+
+def test_domain_cache():
+    cache = DomainCache(max_size=1)
+    basic = problems["basic"].problem
+    domain = cache.get(basic, lambda: SkDecideDomain(basic))
+    assert cache.get(basic, lambda: None) is not domain
+    assert cache.get(basic, lambda: None)._simulator is domain._simulator
+    robot = problems["robot"].problem
+    cache.get(robot, lambda: SkDecideDomain(robot))
+    assert len(cache) == 1
+    assert cache.get(basic, lambda: None) is None
+
+
+def test_domain_cache_limits():
+    cache = DomainCache()
+    basic, robot = problems["basic"].problem, problems["robot"].problem
+    assert problem_key(basic) == problem_key(basic)
+    domain = cache.get(
+        problem_key(basic), lambda: SkDecideDomain(basic, state_encoding="vector")
+    )
+    cache.get(problem_key(robot), lambda: SkDecideDomain(robot))
+    total = sum(_estimate_size(d) for d in cache._domains.values())
+    cache.set_limits(max_memory=total)
+    assert len(cache) == 2
+    # the states memoized by the copy do not grow the cached domain
+    state = domain.get_initial_state()
+    domain.get_next_state(state, domain.get_applicable_actions(state).sample())
+    assert len(domain._states_up2np) > 0
+    assert len(cache._domains[problem_key(basic)]._states_up2np) == 0
+    cache.set_limits(max_memory=total - 1)
+    assert len(cache) == 1
+    with pytest.raises(RuntimeError):
+        cache.set_limits(max_size=-1)
+
+
+def test_domain_cache_problem_modified():
+    problem = problems["basic_conditional"].problem.clone()
+    for encoding in ("vector", "bitset", "numpy"):
+        with OneshotPlanner(
+            name="skdecide",
+            params={"solver": IW, "config": {"state_encoding": encoding}},
+        ) as planner:
+            problem.clear_goals()
+            problem.add_goal(problem.fluent("x"))
+            res = planner.solve(problem)
+            assert [a.action.name for a in res.plan.actions] == ["a_y", "a_x"]
+            # the domain of the solved problem is not reused once modified
+            problem.clear_goals()
+            problem.add_goal(problem.fluent("y"))
+            res = planner.solve(problem)
+            assert [a.action.name for a in res.plan.actions] == ["a_y"]
+    z = Fluent("z")
+    problem.add_fluent(z, default_initial_value=False)
+    a_z = InstantaneousAction("a_z")
+    a_z.add_effect(z, True)
+    problem.add_action(a_z)
+    problem.clear_goals()
+    problem.add_goal(z)
+    with OneshotPlanner(
+        name="skdecide",
+        params={"solver": IW, "config": {"state_encoding": "vector"}},
+    ) as planner:
+        res = planner.solve(problem)
+        assert [a.action.name for a in res.plan.actions] == ["a_z"]
+
+
+def test_planner_invalid_config():
+    with pytest.raises(RuntimeError):
+        EngineImpl(solver=IW, config={"state_encoding": "bitmap"})
+    with pytest.raises(RuntimeError):
+        EngineImpl(solver=IW, config={}, simulator_params={"simulator": object})
+
+
+def test_planner_bitset():
+    for name, action_encoding in (
+        ("basic_with_costs", "native"),
+        ("robot_loader_weak_bridge", "int"),
+        ("hierarchical_blocks_world", "native"),
+    ):
+        problem = problems[name].problem
+        with OneshotPlanner(
+            name="skdecide",
+            params={
+                "solver": Astar,
+                "config": {
+                    "state_encoding": "bitset",
+                    "action_encoding": action_encoding,
+                },
+            },
+        ) as planner:
+            res = planner.solve(problem, timeout=60)
+            assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+            with PlanValidator(problem_kind=problem.kind) as validator:
+                assert (
+                    validator.validate(problem, res.plan).status
+                    == ValidationResultStatus.VALID
+                )
+
+
+def test_bitset_successor_generator():
+    domain = BitsetUPDomain(problems["hierarchical_blocks_world"].problem)
+    assert domain._successor_generator.unindexed == []
+    state = domain._get_initial_state()
+    for _ in range(5):
+        applicable = domain._successor_generator.applicable(state.bits)
+        assert applicable == [
+            i
+            for i, (positive, negative) in enumerate(domain._preconditions)
+            if state.bits & positive == positive and state.bits & negative == 0
+        ]
+        state = domain._get_next_state(state, domain._ground_actions[applicable[0]])
+
+
+def test_ground_action_equality():
+    problem = problems["hierarchical_blocks_world"].problem
+    for domain_class in (BitsetUPDomain, NumpyUPDomain):
+        domain = domain_class(problem, action_encoding="int")
+        action = domain._ground_actions[1]
+        # equal to the plain SkUPAction of the same grounded action
+        skup_action = SkUPAction(action._up_action)
+        assert action == skup_action and hash(action) == hash(skup_action)
+        assert domain._convert_from_skup_action_(skup_action) == 1
+        assert action != domain._ground_actions[0]
+
+
+def test_bitset_incremental_applicable():
+    domain = BitsetUPDomain(problems["hierarchical_blocks_world"].problem)
+    state = domain._get_initial_state()
+    for _ in range(5):
+        # a deterministic choice, since moving a block on itself is a dead end
+        action = max(domain._get_applicable_actions_from(state).get_elements(), key=str)
+        state = domain._get_next_state(state, action)
+        # derived from the applicable actions of the parent state
+        derived = domain._applicable_cache[state]
+        assert derived == domain._successor_generator.applicable(state.bits)
+
+
+def test_atom_features():
+    problem = problems["robot_fluent_of_user_type"].problem
+    features = [
+        atom_features(domain, domain._get_initial_state()).tolist()
+        for domain in (
+            SkDecideDomain(problem),
+            BitsetUPDomain(problem),
+            NumpyUPDomain(problem),
+        )
+    ]
+    assert features[0] == features[1] == features[2]
+    with OneshotPlanner(
+        name="skdecide", params={"solver": IW, "config": {"state_encoding": "bitset"}}
+    ) as planner:
+        res = planner.solve(problem)
+        assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+
+
+def test_planner_numpy():
+    problem = problems["robot_fluent_of_user_type"].problem
+    domain = NumpyUPDomain(problem)
+    state = domain._get_initial_state()
+    assert state == domain._get_initial_state()
+    assert all(dtype == np.uint8 for dtype, _ in domain._dtype.fields.values())
+    with OneshotPlanner(
+        name="skdecide",
+        params={"solver": Astar, "config": {"state_encoding": "numpy"}},
+    ) as planner:
+        res = planner.solve(problem)
+        assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        with PlanValidator(problem_kind=problem.kind) as validator:
+            assert (
+                validator.validate(problem, res.plan).status
+                == ValidationResultStatus.VALID
+            )
+
+
+def test_numpy_compiled_expressions():
+    problem = problems["robot_int_battery"].problem
+    domain = NumpyUPDomain(problem)
+    assert all(compiled is not None for compiled in domain._compiled_actions)
+    simulator = UPSequentialSimulator(problem)
+    state = domain._get_initial_state()
+    while not domain._is_terminal(state):
+        up_state = domain._convert_to_skup_state_(state).up_state
+        applicable = domain._get_applicable_actions_from(state).get_elements()
+        assert sorted(map(str, applicable)) == sorted(
+            str(simulator._ground_action(a, p))
+            for a, p in simulator.get_applicable_actions(up_state)
+        )
+        assert {
+            str(a)
+            for a in domain._ground_actions
+            if domain._is_applicable_action(state, a)
+        } == set(map(str, applicable))
+        action = max(applicable, key=str)
+        state = domain._get_next_state(state, action)
+        next_up_state = simulator.apply(
+            up_state, action.up_action, action.up_parameters
+        )
+        assert state == domain._convert_from_skup_state_(SkUPState(next_up_state))
+    assert simulator.is_goal(domain._convert_to_skup_state_(state).up_state)
+
+
+def test_numpy_vectorized_actions():
+    problem = problems["robot_int_battery"].problem
+    domain = NumpyUPDomain(problem, action_encoding="int")
+    states = [domain._get_initial_state()]
+    actions = []
+    while not domain._is_terminal(states[-1]):
+        applicable = domain._get_applicable_actions_from(states[-1]).get_elements()
+        actions.append(max(applicable))
+        states.append(domain._get_next_state(states[-1], actions[-1]))
+    # the matrices are only built for the batch operations
+    assert domain._linear_actions is None
+    values = domain.values_array(states[:-1])
+    assert domain.states_from_array(values) == states[:-1]
+    mask = domain.applicable_mask(values)
+    assert len(domain._linear_actions) == len(domain._ground_actions)
+    for state, row in zip(states, mask):
+        assert set(np.flatnonzero(row)) == set(
+            domain._get_applicable_actions_from(state).get_elements()
+        )
+    next_values = domain.next_values(values, np.array(actions))
+    assert domain.states_from_array(next_values) == states[1:]
+
+
+def test_vector_env():
+    problem = problems["robot_int_battery"].problem
+    env = UPVectorEnv(problem, 3, max_episode_steps=2, invalid_action_cost=5.0)
+    domain = env.domain
+    observations, infos = env.reset()
+    assert (observations == domain.values_array([domain._get_initial_state()])).all()
+    # the first copy reaches the goal, the others try a non-applicable action
+    (move,) = domain._get_applicable_actions_from(domain._get_initial_state())
+    invalid = int(np.flatnonzero(~infos["action_mask"][0])[0])
+    for step in range(2):
+        observations, rewards, terminated, truncated, infos = env.step(
+            [move.index, invalid, invalid]
+        )
+        assert list(rewards) == [-1.0, -5.0, -5.0]
+        assert list(terminated) == [True, False, False]
+        assert list(truncated) == [False, step == 1, step == 1]
+    goal = domain._get_next_state(domain._get_initial_state(), move)
+    assert domain.states_from_array(infos["final_observation"][0][None]) == [goal]
+    assert (observations == env.reset()[0]).all()
+
+
+def test_numpy_fluent_domains():
+    counter = Fluent("counter", IntType())
+    decrement = InstantaneousAction("decrement")
+    decrement.add_decrease_effect(counter, 1)
+    problem = Problem("decrement")
+    problem.add_fluent(counter, default_initial_value=0)
+    problem.add_action(decrement)
+    problem.add_goal(Equals(counter, -1))
+    # the fluent domains are hints which do not bound the values
+    fluent_domains = {FluentExp(counter): (0, 10)}
+    domain = NumpyUPDomain(problem, fluent_domains=fluent_domains)
+    (action,) = domain._get_applicable_actions_from(
+        domain._get_initial_state()
+    ).get_elements()
+    state = domain._get_next_state(domain._get_initial_state(), action)
+    assert list(state) == [-1] and domain._is_terminal(state)
+    env = UPVectorEnv(problem, 1, fluent_domains=fluent_domains)
+    assert env.single_observation_space.low[0] == np.iinfo(np.int64).min
+
+
+def test_planner_int_action_instances():
+    counter = Fluent("counter", IntType(0, 5))
+    increment = InstantaneousAction("increment")
+    increment.add_increase_effect(counter, 1)
+    problem = Problem("counter")
+    problem.add_fluent(counter, default_initial_value=0)
+    problem.add_action(increment)
+    problem.add_goal(GE(counter, 3))
+    for encoding in ("vector", "numpy"):
+        with OneshotPlanner(
+            name="skdecide",
+            params={
+                "solver": IW,
+                "config": {"state_encoding": encoding, "action_encoding": "int"},
+            },
+        ) as planner:
+            plan = planner.solve(problem).plan
+            assert len(plan.actions) == 3
+            # the repeated actions are distinct action instances
+            assert len(set(map(id, plan.actions))) == 3
+            assert (
+                len(
+                    plan.convert_to(
+                        PlanKind.PARTIAL_ORDER_PLAN, problem
+                    ).get_adjacency_list
+                )
+                == 3
+            )
+            # built once by the cached domain
+            assert planner.solve(problem).plan.actions[0] is plan.actions[0]
+
+
+class CountingSimulator(UPSequentialSimulator):
+    applied = 0
+
+    def _apply(self, state, action_or_action_instance, parameters=None):
+        CountingSimulator.applied += 1
+        return super()._apply(state, action_or_action_instance, parameters)
+
+
+def test_planner_simulator():
+    problem = problems["basic"].problem
+    for simulator in ("sequential_simulator", CountingSimulator):
+        with OneshotPlanner(
+            name="skdecide",
+            params={
+                "solver": IW,
+                "config": {
+                    "state_encoding": "vector",
+                    "use_domain_cache": False,
+                },
+                "simulator_params": {"simulator": simulator},
+            },
+        ) as planner:
+            res = planner.solve(problem)
+            assert str(res.plan) == str(problems["basic"].valid_plans[0])
+    assert CountingSimulator.applied > 0
+
+
+def test_planner_simulator_built_once(monkeypatch):
+    built = []
+    init = UPSequentialSimulator.__init__
+
+    def counting_init(self, *args, **kwargs):
+        built.append(type(self))
+        init(self, *args, **kwargs)
+
+    monkeypatch.setattr(UPSequentialSimulator, "__init__", counting_init)
+    problem = problems["basic"].problem
+    for encoding in ("vector", "bitset", "numpy"):
+        engine = EngineImpl(
+            solver=IW,
+            config={"state_encoding": encoding},
+            simulator_params={"simulator": CountingSimulator},
+        )
+        domain = engine._config.build_domain(problem)
+        assert isinstance(domain._simulator, CountingSimulator)
+    # the default simulator is not built only to be replaced
+    assert built == [CountingSimulator] * 3
+    # and is still built by the UPDomain instances of other code
+    assert skdecide_up.UPSequentialSimulator is UPSequentialSimulator
+
+
+def _robot_with_simulated_effects(calls):
+    Location = UserType("Location")
+    Robot = UserType("Robot")
+    at = Fluent("at", Location, robot=Robot)
+    battery_charge = Fluent("battery_charge", IntType(0, 100), robot=Robot)
+    move = InstantaneousAction("move", robot=Robot, l_from=Location, l_to=Location)
+    robot, l_from, l_to = move.parameters
+    move.add_precondition(Equals(at(robot), l_from))
+    move.add_precondition(GE(battery_charge(robot), 10))
+    move.add_precondition(Not(Equals(l_from, l_to)))
+    move.add_effect(at(robot), l_to)
+
+    def fun(problem, state, actual_params):
+        calls.append(threading.get_ident())
+        value = state.get_value(battery_charge(actual_params.get(robot)))
+        return [Int(value.constant_value() - 10)]
+
+    move.set_simulated_effect(SimulatedEffect([battery_charge(robot)], fun))
+    locations = [Object("l{}".format(i), Location) for i in range(4)]
+    r1 = Object("r1", Robot)
+    problem = Problem("robot_with_simulated_effects")
+    problem.add_fluent(at)
+    problem.add_fluent(battery_charge)
+    problem.add_action(move)
+    problem.add_objects(locations + [r1])
+    problem.set_initial_value(at(r1), locations[0])
+    problem.set_initial_value(battery_charge(r1), 100)
+    problem.add_goal(Equals(at(r1), locations[3]))
+    return problem
+
+
+def test_planner_simulated_effect_cache():
+    calls = []
+    problem = _robot_with_simulated_effects(calls)
+    with OneshotPlanner(
+        name="skdecide",
+        params={
+            "solver": IW,
+            "config": {
+                "state_encoding": "vector",
+                "use_domain_cache": False,
+                "simulated_effect_cache_size": 128,
+            },
+        },
+    ) as planner:
+        res = planner.solve(problem)
+        assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        hits = int(res.metrics["simulated_effect_cache_hits"])
+        misses = int(res.metrics["simulated_effect_cache_misses"])
+        assert hits > 0
+        assert misses == len(calls)
+
+
+def test_planner_simulated_effect_workers():
+    for executor in ("process", "thread"):
+        calls = []
+        problem = _robot_with_simulated_effects(calls)
+        with OneshotPlanner(
+            name="skdecide",
+            params={
+                "solver": IW,
+                "config": {
+                    "state_encoding": "vector",
+                    "simulated_effect_workers": 2,
+                    "simulated_effect_executor": executor,
+                },
+            },
+        ) as planner:
+            res = planner.solve(problem)
+        # the workers are stopped at the end of the solve
+        assert len(mp.active_children()) == 0
+        assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
+        with PlanValidator(problem_kind=problem.kind) as validator:
+            assert (
+                validator.validate(problem, res.plan).status
+                == ValidationResultStatus.VALID
+            )
+        if executor == "thread":
+            assert any(ident != threading.get_ident() for ident in calls)
+            # the node creation is only locked while the worker threads run
+            em = problem.environment.expression_manager
+            assert em.create_node.__func__ is type(em).create_node
+
+
+def test_portfolio_planner_simulated_effect_workers():
+    problem = _robot_with_simulated_effects([])
+    member = {
+        "solver": IW,
+        "config": {"state_encoding": "vector", "simulated_effect_workers": 2},
+    }
+    with OneshotPlanner(
+        name="skdecide", params={"portfolio": [member, member]}
+    ) as planner:
+        # the members are not daemonic and can start their own workers
+        res = planner.solve(problem, timeout=60)
+    assert len(mp.active_children()) == 0
+    assert res.status == PlanGenerationResultStatus.SOLVED_SATISFICING
@@ -0,0 +1,160 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines a Gymnasium vector environment stepping many copies of
+a UP problem at once."""
+
+from typing import Dict, List, Optional, Union
+import numpy as np
+import unified_planning as up
+from gymnasium.spaces import Box, Discrete
+from gymnasium.vector import VectorEnv
+from up_skdecide.numpy_state import NumpyUPDomain
+
+
+class UPVectorEnv(VectorEnv):
+    """Gymnasium `VectorEnv` running `num_envs` independent episodes of a UP
+    problem, whose states are stored as one int64 matrix of fluent values and
+    stepped with the batch operations of `NumpyUPDomain`.
+
+    The observations are the values of the non-static fluents (as in the
+    'numpy' state encoding), the actions are the indices of the ground actions
+    (as in the 'int' action encoding) and the rewards are the opposites of the
+    transition costs. An episode terminates when it reaches a goal and is
+    truncated after `max_episode_steps` steps or in a state without applicable
+    actions. The copies are automatically reset as in the Gymnasium vector
+    environments, with the final observations in the infos. The infos also
+    contain the "action_mask" of the applicable actions of the observations.
+    """
+
+    def __init__(
+        self,
+        problem: Union["up.model.Problem", NumpyUPDomain],
+        num_envs: int,
+        max_episode_steps: Optional[int] = None,
+        invalid_action_cost: Optional[float] = None,
+        **domain_params
+    ):
+        """
+        :param problem: The UP problem, or the NumpyUPDomain wrapping it.
+        :param num_envs: The number of copies of the environment.
+        :param max_episode_steps: The number of steps after which the episodes
+            are truncated, if any.
+        :param invalid_action_cost: The cost of the actions which are not
+            applicable, which then leave the state unchanged; if None, stepping
+            an action which is not applicable raises a RuntimeError.
+        :param domain_params: The parameters of the NumpyUPDomain built if a
+            problem is given.
+        """
+        self._domain = (
+            problem
+            if isinstance(problem, NumpyUPDomain)
+            else NumpyUPDomain(problem, **domain_params)
+        )
+        self._max_episode_steps = max_episode_steps
+        self._invalid_action_cost = invalid_action_cost
+        low: List[int] = []
+        high: List[int] = []
+        for fn in self._domain._fluents:
+            fluent_type = fn.fluent().type
+            if fluent_type.is_bool_type():
+                lb, ub = 0, 1
+            elif fluent_type.is_user_type():
+                lb, ub = 0, len(list(self._domain._problem.objects(fluent_type))) - 1
+            else:
+                lb, ub = NumpyUPDomain._fluent_bounds(fn)
+            low.append(np.iinfo(np.int64).min if lb is None else lb)
+            high.append(np.iinfo(np.int64).max if ub is None else ub)
+        super().__init__(
+            num_envs,
+            Box(np.array(low), np.array(high), dtype=np.int64),
+            Discrete(len(self._domain._ground_actions)),
+        )
+        self._initial_values = self._domain.values_array(
+            [self._domain._get_initial_state()]
+        )[0]
+        self._initial_mask = self._domain.applicable_mask(self._initial_values[None])[0]
+        self._values = np.tile(self._initial_values, (num_envs, 1))
+        self._mask = np.tile(self._initial_mask, (num_envs, 1))
+        self._steps = np.zeros(num_envs, dtype=np.int64)
+        self._actions = None
+
+    @property
+    def domain(self) -> NumpyUPDomain:
+        """The NumpyUPDomain of the environments."""
+        return self._domain
+
+    def reset_wait(
+        self,
+        seed: Optional[Union[int, List[int]]] = None,
+        options: Optional[dict] = None,
+    ):
+        # the initial state of a UP problem is deterministic
+        self._values[:] = self._initial_values
+        self._mask[:] = self._initial_mask
+        self._steps[:] = 0
+        return self._values.copy(), self._infos()
+
+    def step_async(self, actions):
+        self._actions = np.asarray(actions, dtype=np.int64)
+
+    def step_wait(self):
+        actions, self._actions = self._actions, None
+        indices = np.arange(self.num_envs)
+        valid = self._mask[indices, actions]
+        if self._invalid_action_cost is None and not valid.all():
+            i = np.flatnonzero(~valid)[0]
+            raise RuntimeError(
+                "Action {} is not applicable in environment {}".format(
+                    self._domain._ground_actions[actions[i]], i
+                )
+            )
+        values = self._values[valid]
+        next_values = self._values.copy()
+        next_values[valid] = self._domain.next_values(values, actions[valid])
+        costs = np.full(self.num_envs, self._invalid_action_cost or 0.0)
+        costs[valid] = self._domain.transition_costs(
+            values, actions[valid], next_values[valid]
+        )
+        self._steps += 1
+        terminated = self._domain.goal_mask(next_values)
+        next_mask = self._domain.applicable_mask(next_values)
+        truncated = ~terminated & ~next_mask.any(axis=1)
+        if self._max_episode_steps is not None:
+            truncated |= ~terminated & (self._steps >= self._max_episode_steps)
+        done = terminated | truncated
+        infos: Dict[str, np.ndarray] = {}
+        if done.any():
+            final_observations = np.empty(self.num_envs, dtype=object)
+            final_infos = np.empty(self.num_envs, dtype=object)
+            for i in np.flatnonzero(done):
+                final_observations[i] = next_values[i].copy()
+                final_infos[i] = {}
+            infos["final_observation"] = final_observations
+            infos["_final_observation"] = done
+            infos["final_info"] = final_infos
+            infos["_final_info"] = done
+            next_values[done] = self._initial_values
+            next_mask[done] = self._initial_mask
+            self._steps[done] = 0
+        self._values = next_values
+        self._mask = next_mask
+        infos.update(self._infos())
+        return self._values.copy(), -costs, terminated, truncated, infos
+
+    def _infos(self) -> Dict[str, np.ndarray]:
+        return {
+            "action_mask": self._mask.copy(),
+            "_action_mask": np.ones(self.num_envs, dtype=bool),
+        }
@@ -0,0 +1,149 @@
+# Copyright 2021 AIPlan4EU project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""This module defines the matrix form of the ground actions whose
+preconditions and effects are linear, evaluated on many states at once."""
+
+from typing import Dict, List, Tuple
+import numpy as np
+from up_skdecide.expressions import _LinearAction
+
+
+class _SparseConstraints:
+    """Constraints `A . x <= b` over the int64 values x of the fluents, whose
+    matrix A is stored by rows as its non-zero coefficients, since each
+    constraint only mentions a few fluents."""
+
+    def __init__(self, rows: List[Tuple[Dict[int, int], int]]):
+        """
+        :param rows: The coefficients and bound of each constraint.
+        """
+        # an explicit zero keeps the empty (trivially satisfied) rows, so that
+        # each row is a non-empty slice of the coefficients
+        entries = [
+            (r, i, c)
+            for r, (coefficients, _) in enumerate(rows)
+            for i, c in (coefficients.items() if len(coefficients) > 0 else [(0, 0)])
+        ]
+        self._rows = np.array([r for r, _, _ in entries], dtype=np.int64)
+        self._columns = np.array([i for _, i, _ in entries], dtype=np.int64)
+        self._coefficients = np.array([c for _, _, c in entries], dtype=np.int64)
+        self._starts = np.flatnonzero(np.diff(self._rows, prepend=-1) != 0).astype(
+            np.int64
+        )
+        self._bounds = np.array([bound for _, bound in rows], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._bounds)
+
+    def satisfied(self, values: np.ndarray) -> np.ndarray:
+        """Returns the Boolean matrix (states x constraints) of the constraints
+        satisfied by each row of the int64 matrix of values."""
+        if len(self._bounds) == 0:
+            return np.ones(values.shape[:-1] + (0,), dtype=bool)
+        products = values[..., self._columns] * self._coefficients
+        return np.add.reduceat(products, self._starts, axis=-1) <= self._bounds
+
+
+class _LinearActions:
+    """Ground actions whose preconditions are conjunctions of the constraints
+    `A . x <= b` over the int64 values x of the fluents, and whose effects are
+    `x' = where(M, V, x) + D` with a constant assignment mask M, assigned
+    values V and deltas D.
+
+    Evaluating the preconditions of all the actions on a batch of states is
+    then a single sparse matrix product, and applying a batch of actions to a
+    batch of states a single masked update. The matrices are stored sparse,
+    by their non-zero entries, so that their size follows the number of
+    fluents mentioned by the actions rather than that of all the fluents.
+    """
+
+    def __init__(self, actions: List[Tuple[int, _LinearAction]]):
+        """
+        :param actions: The index of each linear action and its linear form.
+        """
+        self.indices = np.array([i for i, _ in actions], dtype=np.int64)
+        n_actions = len(actions)
+        rows: List[Tuple[dict, int]] = []
+        starts = np.empty(n_actions, dtype=np.int64)
+        # (fluent, assigned, value, delta) of the fluents updated by each action
+        updates: List[Tuple[int, bool, int, int]] = []
+        self._update_starts = np.empty(n_actions + 1, dtype=np.int64)
+        self.costs = np.empty(n_actions, dtype=np.int64)
+        for k, (_, (constraints, assignments, increases, cost)) in enumerate(actions):
+            starts[k] = len(rows)
+            # a trivially satisfied row keeps the groups of rows non-empty
+            rows.extend(constraints if len(constraints) > 0 else [({}, 0)])
+            self._update_starts[k] = len(updates)
+            for i in sorted(set(assignments) | set(increases)):
+                updates.append(
+                    (
+                        i,
+                        i in assignments,
+                        assignments.get(i, 0),
+                        increases.get(i, 0),
+                    )
+                )
+            self.costs[k] = cost
+        self._update_starts[n_actions] = len(updates)
+        self._starts = starts
+        self._constraints = _SparseConstraints(rows)
+        self._updated = np.array([i for i, _, _, _ in updates], dtype=np.int64)
+        self._assigned = np.array([a for _, a, _, _ in updates], dtype=bool)
+        self._values = np.array([v for _, _, v, _ in updates], dtype=np.int64)
+        self._deltas = np.array([d for _, _, _, d in updates], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def applicable(self, values: np.ndarray) -> np.ndarray:
+        """Returns the Boolean matrix (states x actions) of the actions
+        applicable in each row of the int64 matrix of values."""
+        if len(self.indices) == 0:
+            return np.zeros(values.shape[:-1] + (0,), dtype=bool)
+        satisfied = self._constraints.satisfied(values)
+        return np.logical_and.reduceat(satisfied, self._starts, axis=-1)
+
+    def apply(self, values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """Returns the values of the successors of the rows of values by the
+        actions at the given positions (one per row), assumed applicable."""
+        starts = self._update_starts[positions]
+        counts = self._update_starts[positions + 1] - starts
+        # the rows of values and the updates of their actions, flattened
+        rows = np.repeat(np.arange(len(positions)), counts)
+        updates = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(
+            counts.sum()
+        )
+        columns = self._updated[updates]
+        assigned = self._assigned[updates]
+        next_values = np.array(values, dtype=np.int64)
+        next_values[rows[assigned], columns[assigned]] = self._values[updates][assigned]
+        next_values[rows, columns] += self._deltas[updates]
+        return next_values
+
+
+class _LinearCondition:
+    """Conjunction of the constraints `A . x <= b` over the int64 values x of
+    the fluents."""
+
+    def __init__(self, rows: List[Tuple[Dict[int, int], int]]):
+        """
+        :param rows: The coefficients and bound of each constraint.
+        """
+        self._constraints = _SparseConstraints(rows)
+
+    def __call__(self, values: np.ndarray) -> np.ndarray:
+        """Returns the Boolean vector of the rows of values satisfying the
+        condition."""
+        return np.all(self._constraints.satisfied(values), axis=-1)